@@ -10,6 +10,7 @@ common_functions = {
     'parse_xml'           : lambda p1: xml_parser(p1),
     'run_local_cmd'       : lambda p1 : run_local_cmd(p1),
     'run_remote_cmd'      : lambda p1,p2,p3,p4,p5 : run_remote_cmd(p1, p2, p3, p4, p5),
+    'run_remote_many'     : lambda p1,p2,p3,p4 : run_remote_many(p1, p2, p3, p4),
     'sftp_tranport'       : lambda p1,p2,p3,p4,p5,p6 : transport_file(p1, p2, p3, p4, p5, p6),
     
 }
@@ -90,28 +91,225 @@ def run_local_cmd(cmd):
     except Exception, e:
         print 'Failed to run local command <%s> with error: %s' %(cmd, e)
 
+import socket
+import threading
+import atexit
 import paramiko
+class SSHConnectionPool:
+    '''
+    Keep authenticated SSH connections alive and share them between commands.
+    Connections are keyed by (host, port, user). Every command opens its own
+    channel on the shared transport, so several commands can run over one
+    connection at the same time. Dead transports are re-established once
+    transparently, idle ones are closed after idle_timeout seconds.
+    '''
+    def __init__(self, idle_timeout=300, keepalive=30):
+        self.idle_timeout = idle_timeout
+        self.keepalive = keepalive
+        self._entries = {}  # (host, port, user) -> {'client', 'last_used', 'busy'}
+        self._key_locks = {}
+        self._lock = threading.Lock()
+
+    def _connect(self, host, port, user, password, timeout=None):
+        ssh = paramiko.SSHClient()
+        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        try:
+            ssh.connect(host, username=user, password=password, port=port, allow_agent=False, look_for_keys=False, timeout=timeout)
+        except Exception:
+            ssh.close()
+            raise
+        if self.keepalive > 0:
+            ssh.get_transport().set_keepalive(self.keepalive)
+        return ssh
+
+    def _is_alive(self, ssh):
+        transport = ssh.get_transport()
+        return transport is not None and transport.is_active()
+
+    def _key_lock(self, key):
+        with self._lock:
+            return self._key_locks.setdefault(key, threading.Lock())
+
+    def close_idle(self):
+        '''
+        Close every connection that has not been used for idle_timeout seconds
+        '''
+        now = time.time()
+        with self._lock:
+            for key in self._entries.keys():
+                entry = self._entries[key]
+                if entry['busy'] == 0 and now - entry['last_used'] > self.idle_timeout:
+                    entry['client'].close()
+                    del self._entries[key]
+
+    def close_all(self):
+        with self._lock:
+            for entry in self._entries.values():
+                entry['client'].close()
+            self._entries.clear()
+
+    def discard(self, host, port, user, client=None):
+        '''
+        Close the pooled connection of (host, port, user). When client is given,
+        only if it is still the pooled one, so a fresh reconnect is kept.
+        '''
+        with self._lock:
+            entry = self._entries.get((host, port, user))
+            if entry is None or (client is not None and entry['client'] is not client):
+                return
+            del self._entries[(host, port, user)]
+        entry['client'].close()
+
+    def acquire(self, host, port, user, password, timeout=None):
+        '''
+        Return a live SSHClient for (host, port, user), connecting if needed.
+        Each acquire() must be paired with a release().
+        '''
+        self.close_idle()
+        key = (host, port, user)
+        with self._key_lock(key):
+            with self._lock:
+                entry = self._entries.get(key)
+            if entry is not None and not self._is_alive(entry['client']):
+                self.discard(host, port, user)
+                entry = None
+            if entry is None:
+                entry = {'client': self._connect(host, port, user, password, timeout), 'last_used': time.time(), 'busy': 0}
+                with self._lock:
+                    self._entries[key] = entry
+            with self._lock:
+                entry['busy'] += 1
+                entry['last_used'] = time.time()
+            return entry['client']
+
+    def release(self, host, port, user):
+        with self._lock:
+            entry = self._entries.get((host, port, user))
+            if entry is not None:
+                entry['busy'] = max(entry['busy'] - 1, 0)
+                entry['last_used'] = time.time()
+
+    def exec_command(self, host, port, user, password, cmd, timeout=None):
+        '''
+        Run cmd on a pooled connection and return (stdout_lines, stderr_lines).
+        Only when the transport turns out dead while opening the channel, i.e.
+        before cmd was sent, is it reconnected and retried once, so a command
+        never runs twice. Errors of the channel alone, e.g. sshd MaxSessions
+        reached, leave the shared transport open for the other commands.
+        '''
+        for attempt in (1, 2):
+            ssh = self.acquire(host, port, user, password, timeout)
+            try:
+                transport = ssh.get_transport()
+                try:
+                    chan = transport.open_session(timeout=timeout)
+                except (paramiko.SSHException, EOFError, socket.error):
+                    if transport.is_active() or attempt == 2:
+                        raise
+                    self.discard(host, port, user, ssh)
+                    continue
+                try:
+                    chan.settimeout(timeout)
+                    chan.exec_command(cmd)
+                    stdout = chan.makefile('r', -1)
+                    stderr = chan.makefile_stderr('r', -1)
+                    return (stdout.readlines(), stderr.readlines())
+                except Exception:
+                    if not transport.is_active():
+                        self.discard(host, port, user, ssh)
+                    raise
+                finally:
+                    chan.close()
+            finally:
+                self.release(host, port, user)
+
+ssh_pool = SSHConnectionPool()
+atexit.register(ssh_pool.close_all)
+
 def run_remote_cmd(host, port, user, password, cmd):
     '''
-    Execute a shell command in remote environment via SSH
+    Execute a shell command in remote environment via SSH.
+    The connection is taken from ssh_pool and kept open for the next command.
     '''
-    ssh = paramiko.SSHClient()
-    ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
     try:
-        ssh.connect(host, username=user, password=password, port=port, allow_agent=False, look_for_keys=False)
+        (out, err) = ssh_pool.exec_command(host, port, user, password, cmd)
     except Exception, e:
-        ssh.close()
         print 'Failed to run remote command <%s> on host <%s> with error: %s' %(cmd, host, e)
+        return None
 
-    (_, stdout, stderr) = ssh.exec_command(cmd)
-    if stderr.readlines() != '':
-        ssh.close()
-        print 'Failed to run remote command <%s> to host <%s> with error: %s' %(cmd, host, stderr.read())
-    
-    out = stdout.readlines()
-    ssh.close()
+    if err:
+        print 'Failed to run remote command <%s> to host <%s> with error: %s' %(cmd, host, ''.join(err))
     return out
-        
+
+import Queue
+def run_remote_many(hosts, cmd, concurrency=10, timeout=60, total_timeout=None):
+    '''
+    Execute a shell command on many remote hosts in parallel via pooled SSH
+        hosts          : list of (host, port, user, password)
+        concurrency    : max number of hosts being worked on at the same time
+        timeout        : seconds allowed for a single host
+        total_timeout  : seconds allowed for the whole sweep, None for no limit
+    This is a generator. (host, output_lines, error, cost) is yielded as soon as
+    each host finishes, so a slow host never holds back the others. error is
+    None on success.
+    '''
+    hosts = list(hosts)
+    tasks = Queue.Queue()
+    results = Queue.Queue()
+    stop = threading.Event()
+    started = {}
+    for i in range(len(hosts)):
+        tasks.put(i)
+
+    def worker():
+        while not stop.is_set():
+            try:
+                i = tasks.get_nowait()
+            except Queue.Empty:
+                return
+            (host, port, user, password) = hosts[i]
+            started[i] = time.time()
+            try:
+                (out, err) = ssh_pool.exec_command(host, port, user, password, cmd, timeout)
+                error = ''.join(err) or None
+            except Exception, e:
+                (out, error) = (None, str(e) or e.__class__.__name__)
+            results.put((i, out, error, time.time()))
+
+    for n in range(min(concurrency, len(hosts))):
+        t = threading.Thread(target=worker)
+        t.daemon = True
+        t.start()
+
+    begin = time.time()
+    pending = set(range(len(hosts)))
+    try:
+        while pending:
+            #a host that has not started yet can not expire earlier than now + timeout
+            now = time.time()
+            deadlines = [started[i] + timeout for i in pending if i in started] + [now + timeout]
+            if total_timeout is not None:
+                deadlines.append(begin + total_timeout)
+            try:
+                (i, out, error, end) = results.get(timeout=max(min(deadlines) - now, 0))
+            except Queue.Empty:
+                now = time.time()
+                if total_timeout is not None and now >= begin + total_timeout:
+                    stop.set()
+                    for i in sorted(pending):
+                        yield (hosts[i][0], None, 'total timeout after %ss' %total_timeout, now - started.get(i, now))
+                    return
+                for i in [i for i in pending if i in started and now >= started[i] + timeout]:
+                    pending.discard(i)
+                    yield (hosts[i][0], None, 'timeout after %ss' %timeout, now - started[i])
+                continue
+            #late results of hosts that already timed out are dropped
+            if i in pending:
+                pending.discard(i)
+                yield (hosts[i][0], out, error, end - started[i])
+    finally:
+        stop.set()
+
 def transport_file(host, port, user, password, operation, local_path, remote_path):
     '''
     Use SFTP client to upload/download a file to/from SFTP server 
@@ -154,6 +352,26 @@ def test_operation(index):
     cost = time.time() - cur
     print '%s result: %s, cost: %s' %(index, a, cost)
 
+def benchmark_remote_cmd(host, port, user, password, cmd, count=100):
+    '''
+    Compare a fresh SSH handshake per command against the pooled connection.
+    A local sshd is enough as the target host.
+    '''
+    cur = time.time()
+    for i in range(count):
+        ssh = ssh_pool._connect(host, port, user, password)
+        (_, stdout, _) = ssh.exec_command(cmd)
+        stdout.read()
+        ssh.close()
+    cost1 = time.time() - cur
+    print 'Fresh connection per command, %d runs total time cost: %s' %(count, cost1)
+
+    cur = time.time()
+    for i in range(count):
+        run_remote_cmd(host, port, user, password, cmd)
+    cost2 = time.time() - cur
+    print 'Pooled connection, %d runs total time cost: %s' %(count, cost2)
+
 def single_thread_run(operation, params):
     '''
     '''
@@ -248,4 +466,5 @@ if __name__ == '__main__':
     #multi_thread_run(4, test_operation, [1,2,3,4])
     #multi_thread_run2(test_operation, [1,2,3,4])
     multi_thread_run3(test_operation, [1,2,3,4])
+    #benchmark_remote_cmd('localhost', 22, 'led', 'led', 'uname -a', 100)
     #print mul.cpu_count()
@@ -2,12 +2,135 @@
 import os
 import re
 import sys
+import csv
+import gzip
+import io
 import json
+import time
 import types
-import datetime
+import array
+import threading
 import subprocess
+import Queue
+import cStringIO
+import multiprocessing
+import collections
 
 #######Class Section#########
+class ChangeStore:
+    '''Column-oriented store of parsed changes.
+       Every field is kept in its own array, owners as indexes into self.owners
+       and timestamps as epoch seconds, 0 meaning missing.'''
+    def __init__(self):
+        self.ids = []
+        self.owners = []
+        self.__ownerIndex = {}
+        self.owner = array.array('i')
+        self.patchSets = array.array('i')
+        self.minus1 = array.array('i')
+        self.minus2 = array.array('i')
+        self.createdOn = array.array('l')
+        self.lastCommitOn = array.array('l')
+        self.scmVerifyOn = array.array('l')
+        self.reviewOn = array.array('l')
+        self.submitOn = array.array('l')
+    
+    def __len__(self):
+        return len(self.ids)
+    
+    def append(self, id, owner, patchSets, minus1, minus2, createdOn, lastCommitOn, scmVerifyOn, reviewOn, submitOn):
+        if owner not in self.__ownerIndex:
+            self.__ownerIndex[owner] = len(self.owners)
+            self.owners.append(owner)
+        self.ids.append(id)
+        self.owner.append(self.__ownerIndex[owner])
+        self.patchSets.append(patchSets)
+        self.minus1.append(minus1)
+        self.minus2.append(minus2)
+        self.createdOn.append(createdOn)
+        self.lastCommitOn.append(lastCommitOn)
+        self.scmVerifyOn.append(scmVerifyOn)
+        self.reviewOn.append(reviewOn)
+        self.submitOn.append(submitOn)
+    
+    def durations(self, endColumn, startColumn = None):
+        '''end - start in seconds for every change that has both timestamps'''
+        if startColumn == None:
+            startColumn = self.createdOn
+        return array.array('l', [e - s for (e, s) in zip(endColumn, startColumn) if e and s])
+    
+    def percentiles(self, values, points = (50, 90, 99)):
+        values = sorted(values)
+        if not values:
+            return dict([(p, None) for p in points])
+        return dict([(p, values[min(len(values) * p / 100, len(values) - 1)]) for p in points])
+    
+    def ownerStats(self):
+        '''Return {owner: (changes, patchsets, -1 votes, -2 votes, median review latency)}'''
+        count = [0] * len(self.owners)
+        patchSets = [0] * len(self.owners)
+        minus1 = [0] * len(self.owners)
+        minus2 = [0] * len(self.owners)
+        latencies = [[] for i in self.owners]
+        for (o, p, m1, m2, c, r) in zip(self.owner, self.patchSets, self.minus1, self.minus2, self.createdOn, self.reviewOn):
+            count[o] += 1
+            patchSets[o] += p
+            minus1[o] += m1
+            minus2[o] += m2
+            if c and r:
+                latencies[o].append(r - c)
+        result = {}
+        for (i, owner) in enumerate(self.owners):
+            result[owner] = (count[i], patchSets[i], minus1[i], minus2[i], self.percentiles(latencies[i], (50,))[50])
+        return result
+    
+    def outputStats(self):
+        print 'Owner,  Changes,  PatchsetNumber,  -1 Votes/Patchset,  -2 Votes/Patchset,  MedianReviewHours'
+        stats = self.ownerStats()
+        for owner in sorted(stats):
+            (count, patchSets, minus1, minus2, latency) = stats[owner]
+            hours = '' if latency == None else '%.1f' %(latency / 3600.0)
+            print '%s, %d, %d, %.2f, %.2f, %s' %(owner, count, patchSets, float(minus1) / max(patchSets, 1), float(minus2) / max(patchSets, 1), hours)
+        submit = self.percentiles(self.durations(self.submitOn))
+        print '\nSubmit time percentiles (hours): %s' %(', '.join(['p%d=%.1f' %(p, submit[p] / 3600.0) for p in sorted(submit) if submit[p] != None]))
+
+class ResultWriter:
+    '''Keep one result file open for a whole export and write the rows through
+       the csv module in batches of batchSize. Files ending with '.gz' or '.zst'
+       are written gzip or zstd compressed, zstd needs the zstandard module.'''
+    def __init__(self, filePath, append = False, batchSize = 10000, compression = None):
+        self.path = filePath
+        self.batchSize = batchSize
+        path = os.path.dirname(filePath)
+        if path != '' and not os.path.exists(path):
+            os.makedirs(path)
+        (self.__raw, self.__fh) = openResult(filePath, 'ab' if append else 'wb', compression)
+        self.__writer = csv.writer(self.__fh, lineterminator = '\n')
+        self.__batch = []
+        if not append:
+            self.__writer.writerow(RESULT_HEADER)
+    
+    def write(self, rows):
+        self.__batch.extend([rowFields(row) for row in rows])
+        if len(self.__batch) >= self.batchSize:
+            self.flush()
+    
+    def writeText(self, text):
+        '''Write rows that were already formatted as CSV, e.g. by parseChunk()'''
+        self.flush()
+        self.__fh.write(text)
+    
+    def flush(self):
+        if self.__batch:
+            self.__writer.writerows(self.__batch)
+            self.__batch = []
+    
+    def close(self):
+        self.flush()
+        self.__fh.close()
+        if self.__raw is not self.__fh:
+            self.__raw.close()
+
 class GitLogReviewer:
     '''A tool used to parse git log'''
     __jsonList = []
@@ -20,10 +143,13 @@ class GitLogReviewer:
     __sortKey = None
     __endFlag = False
     __gitCmd = '' # your git server access command
+    __writer = None
     
-    def __init__(self, limit):
+    def __init__(self, limit, store = None):
+        '''store: optional ChangeStore that also receives every parsed change'''
         if limit >= 0:
             self.__limit = limit
+        self.__store = store
         
     def loadGitCfg(self, cfgPath):
         try:
@@ -124,72 +250,106 @@ class GitLogReviewer:
         except Exception, ex:
             print '[loadFromCmd2] Exception:', ex
             
+    def streamFromCmd(self, strCmd):
+        '''Run the command and parse every record as soon as its line arrives.
+           The raw output is never buffered, and parsing overlaps the transfer.'''
+        self.__jsonList = []
+        self.__resultList = []
+        self.__loadStatus = False
+        self.__parseStatus = False
+        self.__abandonCount = 0
+        lineCount = 0
+        lastLine = ''
+        p = None
+        try:
+            p = subprocess.Popen(strCmd, shell=True, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+            p.stdin.close()
+            print '\n[streamFromCmd] Start parsing records.'
+            for line in iter(p.stdout.readline, ''):
+                lineCount += 1
+                if line.strip() != '':
+                    lastLine = line
+                if self.parseRecord(line) == 1:
+                    self.__abandonCount += 1
+            #the same checks as fetchPage, a failed or cut query is no end of the records
+            if p.wait() != 0:
+                raise Exception('query failed with exit status %d' %(p.returncode))
+            if lastLine.find('"stats"') == -1:
+                raise Exception('query output ends without the stats row')
+            self.__loadStatus = True
+            self.__parseStatus = True
+            print '[streamFromCmd] %d records have been parsed successfully.' %(len(self.__resultList))
+            print '[streamFromCmd] %d records with \'ABANDONED\' status have been ignored.\n' %(self.__abandonCount)
+        except Exception, ex:
+            print '[streamFromCmd] Exception:', ex
+            if p is not None and p.poll() is None:
+                p.kill()
+                p.wait()
+            return
+        #the same rule as parseAllRecords, whose line list also held a trailing empty line
+        if lineCount + 1 <= self.__limit:
+            self.__endFlag = True
+            
     def parseRecord(self, record):
         '''Return value:
            0 -> Record with right format
            1 -> Record with "ABANDONED" status
            2 -> Record with other formats that do not match requirement
+           Parsed changes are kept as tuples of the exported fields with epoch
+           timestamps, they are only formatted by formatRow() at output time.
         '''
-        #print '1:'
         if type(record) != type('a'):
             return 2
-        if record.find('project') == -1:
+        #cheap rejection of lines that are no change, e.g. the trailing stats row
+        if record.find('"sortKey"') == -1 or record.find('project') == -1:
             return 2
+        if abandonedPattern.search(record) != None:
+            return 1
     
-        dict = json.loads(record)
-        if 'id' not in dict:
-            return 2;
-        id = dict['id']
-        
-        if 'owner' not in dict or 'name' not in dict['owner']:
-            return 2;
-        name =  dict['owner']['name']
-    
-        if 'patchSets' not in dict or 'status' not in dict or 'sortKey' not in dict or 'createdOn' not in dict or 'lastUpdated' not in dict:
-            return 2;
-        if dict['status'] == 'ABANDONED':
-            return 1;
-        
-        createDate = datetime.datetime.fromtimestamp(int(dict['createdOn']))
-        #updateDate = datetime.datetime.fromtimestamp(int(dict['lastUpdated']))
+        change = json.loads(record)
+        try:
+            id = change['id']
+            name = change['owner']['name']
+            patchSets = change['patchSets']
+            if 'status' not in change or 'sortKey' not in change or 'createdOn' not in change or 'lastUpdated' not in change:
+                return 2
+        except (KeyError, TypeError):
+            return 2
+        if change['status'] == 'ABANDONED':
+            return 1
         
-        self.__sortKey = dict['sortKey']
+        self.__sortKey = change['sortKey']
         number = 0
         fail1 = 0
         fail2 = 0
-        lastCommitCreateDate = ''
-        lastSCMVerifyDate = ''
-        reviewDate = ''
-        submitDate = ''
-        for item in dict['patchSets']:
+        for item in patchSets:
             if 'number' not in item or 'approvals' not in item:
                 continue
             number += 1
-            
-            
             for subItem in item['approvals']:
-                if 'value' not in subItem:
-                    continue
-                if subItem['value'] == '-1':
+                value = subItem.get('value')
+                if value == '-1':
                     fail1 += 1
-                elif  subItem['value'] == '-2':
+                elif value == '-2':
                     fail2 += 1
-        #print '2', record
-        lastItem = dict['patchSets'][len(dict['patchSets']) - 1]
-        lastCommitCreateDate = datetime.datetime.fromtimestamp(int(lastItem['createdOn']))
+        
+        lastItem = patchSets[-1]
         if 'approvals' not in lastItem:
-            #print 'Bad record:', record
             return 2
+        (scmVerifyOn, reviewOn, submitOn) = (0, 0, 0)
         for subItem in lastItem['approvals']:
-            if subItem['type'] == 'VRIF' and subItem['by']['name'] == 'New EMA SCM Account':
-                lastSCMVerifyDate = datetime.datetime.fromtimestamp(int(subItem['grantedOn']))
-            if subItem['type'] == 'CRVW':
-                reviewDate = datetime.datetime.fromtimestamp(int(subItem['grantedOn']))
-            if subItem['type'] == 'SUBM':
-                submitDate = datetime.datetime.fromtimestamp(int(subItem['grantedOn']))
+            kind = subItem['type']
+            if kind == 'VRIF' and subItem['by']['name'] == 'New EMA SCM Account':
+                scmVerifyOn = int(subItem['grantedOn'])
+            elif kind == 'CRVW':
+                reviewOn = int(subItem['grantedOn'])
+            elif kind == 'SUBM':
+                submitOn = int(subItem['grantedOn'])
         
-        self.__resultList.append("%s, %s, %d, %d, %d, %s, %s, %s, %s, %s" %(id, name, number, fail1, fail2, createDate, lastCommitCreateDate, lastSCMVerifyDate, reviewDate, submitDate))
-        #print '4'
+        row = (id, name, number, fail1, fail2, int(change['createdOn']), int(lastItem['createdOn']), scmVerifyOn, reviewOn, submitOn)
+        if self.__store != None:
+            self.__store.append(*row)
+        self.__resultList.append(row)
         return 0
     
     def parseAllRecords(self):
@@ -218,49 +378,102 @@ class GitLogReviewer:
         if not self.__parseStatus: 
             return
         
-        print 'Id,  Owner,  PatchsetNumber,  -1 Votes,  -2 Votes, FirstCommitCreateDate, LastCommitCreateDate, LastSCMVerifyDate, ReviewDate, SubmitDate'
+        print ', '.join(RESULT_HEADER)
         for item in self.__resultList:
-            print item
+            print formatRow(item)
         
     
     def save2File(self, filePath, newFlag = True):
+        '''The result file stays open between calls for the same file,
+           until the last page is saved or closeResult() is called'''
         if not self.__parseStatus: 
             return
         
         try:
             print '[save2File] Save records to file: \'%s\'...' %(filePath)
-            if newFlag:
-                path = os.path.dirname(filePath)
-                if path != '' and not os.path.exists(path):
-                    os.makedirs(path)
-                fh = open(filePath, 'w')
-                fh.write('Id,  Owner,  PatchsetNumber,  -1 Votes,  -2 Votes,  FirstCommitCreateDate, LastCommitCreateDate, LastSCMVerifyDate, ReviewDate, SubmitDate\n')
-            else:
-                fh = open(filePath, 'a+')
-            
-            for item in self.__resultList:
-                fh.write(item + '\n')
-            fh.close()
+            if newFlag or self.__writer == None or self.__writer.path != filePath:
+                self.closeResult()
+                self.__writer = ResultWriter(filePath, not newFlag)
+            self.__writer.write(self.__resultList)
             if self.__endFlag:
+                self.closeResult()
                 print '[save2File] All records are saved successfully\n'
         except Exception, ex:
             print '[save2File] Exception:', ex
     
+    def closeResult(self):
+        if self.__writer != None:
+            self.__writer.close()
+            self.__writer = None
+    
     def processFile(self, srcPath, resultPath):
         '''Retrieve records from file and parse them'''
         self.loadFromFile(srcPath)
         self.parseAllRecords()
-        reviewer.save2File(resultPath, True)
+        self.save2File(resultPath, True)
+        self.closeResult()
         
-    def processCmd(self, cfgPath, resultPath):
+    def parallelProcessFile(self, srcPath, resultPath, processes = None, chunkSize = 32 * 1024 * 1024):
+        '''Same result as processFile for big dumps. The file is split into byte
+           ranges of about chunkSize, which are parsed by a process pool and
+           written to the result file in their original order.'''
+        pool = None
+        writer = None
+        try:
+            size = os.path.getsize(srcPath)
+            chunks = [(srcPath, start, min(start + chunkSize, size), self.__store != None) for start in range(0, size, chunkSize)]
+            print '\n[parallelProcessFile] Start parsing %d chunks of \'%s\'.' %(len(chunks), srcPath)
+            pool = multiprocessing.Pool(processes)
+            count = 0
+            self.__abandonCount = 0
+            writer = ResultWriter(resultPath)
+            window = 2 * (processes or multiprocessing.cpu_count())
+            for (rows, text, lineCount, abandonCount) in imapWindow(pool, parseChunk, chunks, window):
+                writer.writeText(text)
+                count += lineCount
+                self.__abandonCount += abandonCount
+                if rows != None:
+                    for row in rows:
+                        self.__store.append(*row)
+            writer.close()
+            writer = None
+            pool.close()
+            pool.join()
+            pool = None
+            print '[parallelProcessFile] %d records have been parsed successfully.' %(count)
+            print '[parallelProcessFile] %d records with \'ABANDONED\' status have been ignored.\n' %(self.__abandonCount)
+        except Exception, ex:
+            print '[parallelProcessFile] Exception:', ex
+        finally:
+            if pool != None:
+                #not terminate(), a worker killed while sending its result can hang the pool
+                #on python 2; only the chunks inside the window are left to finish
+                pool.close()
+                pool.join()
+            if writer != None:
+                #a truncated, and for .gz/.zst corrupt, result is worse than none
+                try:
+                    writer.close()
+                except Exception:
+                    pass
+                if os.path.exists(resultPath):
+                    os.remove(resultPath)
+                    print '[parallelProcessFile] Removed the incomplete result file \'%s\'.' %(resultPath)
+        
+    def processCmd(self, cfgPath, resultPath, stream = False):
         '''Retrieve records from gerrit server and parse them'''
         self.loadGitCfg(cfgPath)
-        self.loadFromCmd2(self.__gitCmd)
-        self.parseAllRecords()
-        self.__endFlag = True
+        if stream:
+            self.streamFromCmd(self.__gitCmd)
+        else:
+            self.loadFromCmd2(self.__gitCmd)
+            self.parseAllRecords()
+        #a failed query must not be reported as a complete export
+        self.__endFlag = self.__loadStatus
         self.save2File(resultPath, True)
+        self.closeResult()
         
-    def loopProcessCmd(self, cfgPath, resultPath):
+    def loopProcessCmd(self, cfgPath, resultPath, stream = False):
         '''Loop retrieving records from gerrit server and parsing them'''
         self.loadGitCfg2(cfgPath)
         newFileFlag = True
@@ -275,8 +488,11 @@ class GitLogReviewer:
                 #resume
                 cmd = self.__gitCmd + ' resume_sortkey:%s' %(self.__sortKey)
                 newFileFlag = False
-            self.loadFromCmd2(cmd)
-            self.parseAllRecords()
+            if stream:
+                self.streamFromCmd(cmd)
+            else:
+                self.loadFromCmd2(cmd)
+                self.parseAllRecords()
             self.save2File(resultPath, newFileFlag)
             
             totalCount += len(self.__resultList)
@@ -284,12 +500,283 @@ class GitLogReviewer:
             if not self.__loadStatus or not self.__parseStatus:
                 print 'l:', self.__loadStatus, 'p:', self.__parseStatus
                 break
+        self.closeResult()
         print '\n[loopProcessCmd] Totally %d records have been parsed successfully.' %(totalCount)
         print '[loopProcessCmd] Totally %d records with \'ABANDONED\' status have been ignored.\n' %(totalAbandonCount)
         
+
+    def fetchPage(self, strCmd):
+        '''Run one paged query and return (lines, sortKey of its last record).
+           Raise an exception when the query fails or its output is cut before
+           the trailing stats row, so a failed page is never taken as the end.'''
+        p = subprocess.Popen(strCmd, shell=True, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        (strResult, strErr) = p.communicate()
+        if p.returncode != 0:
+            raise Exception('[fetchPage] query failed with exit status %d: %s' %(p.returncode, strErr.strip()))
+        lines = strResult.split('\n')
+        last = [line for line in lines if line.strip() != '']
+        if not last or last[-1].find('"stats"') == -1:
+            raise Exception('[fetchPage] query output ends without the stats row')
+        sortKey = None
+        for line in reversed(lines):
+            if line.find('sortKey') != -1:
+                sortKey = json.loads(line).get('sortKey')
+                break
+        return (lines, sortKey)
+
+    def pipeProcessCmd(self, cfgPath, resultPath, queueSize = 2):
+        '''Same result as loopProcessCmd, but the query of the next page starts as
+           soon as the current page is downloaded, while a worker thread parses
+           and saves the pages in order. At most queueSize pages wait in memory.'''
+        self.loadGitCfg2(cfgPath)
+        pages = Queue.Queue(queueSize)
+        totals = {'count' : 0, 'abandon' : 0}
+        
+        def worker():
+            newFileFlag = True
+            while True:
+                lines = pages.get()
+                if lines is None:
+                    break
+                self.__jsonList = lines
+                self.__loadStatus = True
+                self.parseAllRecords()
+                self.save2File(resultPath, newFileFlag)
+                newFileFlag = False
+                totals['count'] += len(self.__resultList)
+                totals['abandon'] += self.__abandonCount
+        
+        t = threading.Thread(target = worker)
+        t.start()
+        sortKey = None
+        try:
+            while True:
+                if sortKey == None:
+                    cmd = self.__gitCmd
+                else:
+                    cmd = self.__gitCmd + ' resume_sortkey:%s' %(sortKey)
+                (lines, sortKey) = self.fetchPage(cmd)
+                pages.put(lines)
+                #the same end rule as parseAllRecords
+                if sortKey == None or len(lines) <= self.__limit:
+                    break
+        except Exception, ex:
+            print '[pipeProcessCmd] Exception:', ex
+        finally:
+            pages.put(None)
+            t.join()
+            self.closeResult()
+        print '\n[pipeProcessCmd] Totally %d records have been parsed successfully.' %(totals['count'])
+        print '[pipeProcessCmd] Totally %d records with \'ABANDONED\' status have been ignored.\n' %(totals['abandon'])
+
+    def loadCheckpoint(self, checkpointPath):
+        try:
+            with open(checkpointPath) as fh:
+                return json.load(fh)
+        except Exception, ex:
+            print '[loadCheckpoint] No checkpoint loaded:', ex
+            return {}
+
+    def saveCheckpoint(self, checkpointPath, checkpoint):
+        tmpPath = checkpointPath + '.tmp'
+        with open(tmpPath, 'w') as fh:
+            json.dump(checkpoint, fh)
+        os.rename(tmpPath, checkpointPath)
+
+    def upsert2File(self, filePath, rows):
+        '''Put rows in front of the existing result file, replacing the old rows of the same changes'''
+        newIds = set([row[0] for row in rows])
+        tmpPath = filePath + '.tmp'
+        writer = ResultWriter(tmpPath, compression = compressionOf(filePath))
+        writer.write(rows)
+        if os.path.exists(filePath):
+            (raw, fh) = openResult(filePath, 'rb')
+            fh.readline()
+            for line in fh:
+                if line.split(',')[0] not in newIds:
+                    writer.writeText(line)
+            fh.close()
+            raw.close()
+        writer.close()
+        os.rename(tmpPath, filePath)
+
+    def incrementalProcessCmd(self, cfgPath, resultPath, checkpointPath = None):
+        '''Retrieve only the changes updated since the last run and upsert them into the result file.
+           The checkpoint keeps the newest lastUpdated/sortKey seen and the ids already exported.'''
+        if checkpointPath == None:
+            checkpointPath = resultPath + '.checkpoint'
+        checkpoint = {}
+        if os.path.exists(resultPath):
+            checkpoint = self.loadCheckpoint(checkpointPath)
+        since = checkpoint.get('lastUpdated', 0)
+        exported = set(checkpoint.get('ids', []))
+        
+        self.loadGitCfg2(cfgPath)
+        rows = []
+        abandonCount = 0
+        newest = (since, checkpoint.get('sortKey'))
+        sortKey = None
+        while True:
+            if sortKey == None:
+                cmd = self.__gitCmd
+            else:
+                cmd = self.__gitCmd + ' resume_sortkey:%s' %(sortKey)
+            try:
+                (lines, sortKey) = self.fetchPage(cmd)
+            except Exception, ex:
+                #keep the result file and checkpoint, the next run fetches the same range again
+                print '[incrementalProcessCmd] Exception:', ex
+                print '[incrementalProcessCmd] Nothing saved, the checkpoint is unchanged.'
+                return False
+            
+            #records come newest first, stop at the first one older than the checkpoint
+            reached = False
+            self.__resultList = []
+            for line in lines:
+                if line.find('lastUpdated') == -1:
+                    continue
+                record = json.loads(line)
+                if int(record['lastUpdated']) < since:
+                    reached = True
+                    break
+                if int(record['lastUpdated']) > newest[0]:
+                    newest = (int(record['lastUpdated']), record.get('sortKey'))
+                if self.parseRecord(line) == 1:
+                    abandonCount += 1
+            rows.extend(self.__resultList)
+            if reached or sortKey == None or len(lines) <= self.__limit:
+                break
+        
+        self.upsert2File(resultPath, rows)
+        newIds = [row[0] for row in rows]
+        updated = len([i for i in newIds if i in exported])
+        exported.update(newIds)
+        self.saveCheckpoint(checkpointPath, {'lastUpdated' : newest[0], 'sortKey' : newest[1], 'ids' : sorted(exported)})
+        print '\n[incrementalProcessCmd] %d new and %d updated records have been saved.' %(len(rows) - updated, updated)
+        print '[incrementalProcessCmd] %d records with \'ABANDONED\' status have been ignored.\n' %(abandonCount)
+        return True
             
 
 #######Function Section#########
+abandonedPattern = re.compile(r'"status":\s*"ABANDONED"')
+
+minuteCache = {}
+def formatTime(timestamp):
+    '''Local time string of an epoch timestamp, empty for 0.
+       The timestamps of a change are mostly close to each other, so the
+       formatted minute is cached and only the seconds are appended.'''
+    if not timestamp:
+        return ''
+    (minute, second) = divmod(timestamp, 60)
+    prefix = minuteCache.get(minute)
+    if prefix == None:
+        if len(minuteCache) > 100000:
+            minuteCache.clear()
+        prefix = minuteCache[minute] = time.strftime('%Y-%m-%d %H:%M:', time.localtime(minute * 60))
+    return '%s%02d' %(prefix, second)
+
+def formatRow(row):
+    '''Printable line of a change tuple built by GitLogReviewer.parseRecord'''
+    return '%s, %s, %d, %d, %d, %s, %s, %s, %s, %s' %(row[0], row[1], row[2], row[3], row[4],
+        formatTime(row[5]), formatTime(row[6]), formatTime(row[7]), formatTime(row[8]), formatTime(row[9]))
+
+RESULT_HEADER = ['Id', 'Owner', 'PatchsetNumber', '-1 Votes', '-2 Votes', 'FirstCommitCreateDate', 'LastCommitCreateDate', 'LastSCMVerifyDate', 'ReviewDate', 'SubmitDate']
+
+def rowFields(row):
+    '''CSV fields of a change tuple built by GitLogReviewer.parseRecord'''
+    return [row[0].encode('utf-8'), row[1].encode('utf-8'), row[2], row[3], row[4],
+        formatTime(row[5]), formatTime(row[6]), formatTime(row[7]), formatTime(row[8]), formatTime(row[9])]
+
+def compressionOf(filePath):
+    if filePath.endswith('.gz'):
+        return 'gzip'
+    if filePath.endswith('.zst'):
+        return 'zstd'
+    return None
+
+def openResult(filePath, mode, compression = None):
+    '''Return (raw file, file to use) for a plain, gzip or zstd result file'''
+    if compression == None:
+        compression = compressionOf(filePath)
+    raw = open(filePath, mode, 1024 * 1024)
+    if compression == 'gzip':
+        return (raw, gzip.GzipFile(fileobj = raw, mode = mode))
+    if compression == 'zstd':
+        try:
+            import zstandard
+        except ImportError:
+            raw.close()
+            raise Exception('zstd output needs the zstandard module: pip install zstandard')
+        if 'r' in mode:
+            return (raw, io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(raw)))
+        return (raw, zstandard.ZstdCompressor().stream_writer(raw))
+    return (raw, raw)
+
+def imapWindow(pool, func, items, window):
+    '''Like pool.imap, but at most window items are handed to the pool at a time'''
+    pending = collections.deque()
+    for item in items:
+        pending.append(pool.apply_async(func, (item,)))
+        if len(pending) >= window:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+def parseChunk(chunk):
+    '''Parse the lines starting inside byte range [start, end) of a dump.
+       Runs in a worker process of GitLogReviewer.parallelProcessFile and
+       returns (rows or None, formatted CSV lines, row count, abandoned count).'''
+    (filePath, start, end, keepRows) = chunk
+    reviewer = GitLogReviewer(0)
+    rows = reviewer._GitLogReviewer__resultList = []
+    abandonCount = 0
+    with open(filePath, 'rb') as fh:
+        if start > 0:
+            #the line running across start belongs to the previous chunk
+            fh.seek(start - 1)
+            pos = start - 1 + len(fh.readline())
+        else:
+            pos = 0
+        while pos < end:
+            line = fh.readline()
+            if not line:
+                break
+            pos += len(line)
+            if reviewer.parseRecord(line) == 1:
+                abandonCount += 1
+    buf = cStringIO.StringIO()
+    csv.writer(buf, lineterminator = '\n').writerows([rowFields(row) for row in rows])
+    return (rows if keepRows else None, buf.getvalue(), len(rows), abandonCount)
+
+def makeSyntheticDump(filePath, count = 100000):
+    '''Write a gerrit query dump with count changes, used by benchmarkParse()'''
+    with open(filePath, 'w') as fh:
+        for i in range(count):
+            t = 1400000000 + i * 100
+            patchSets = []
+            for n in range(1 + i % 3):
+                patchSets.append({'number' : str(n + 1), 'createdOn' : t + n, 'approvals' : [
+                    {'type' : 'VRIF', 'value' : ['1', '-1'][i % 2], 'grantedOn' : t + n + 5, 'by' : {'name' : 'New EMA SCM Account'}},
+                    {'type' : 'CRVW', 'value' : ['2', '-1', '-2'][i % 3], 'grantedOn' : t + n + 10, 'by' : {'name' : 'reviewer'}},
+                    {'type' : 'SUBM', 'value' : '1', 'grantedOn' : t + n + 20, 'by' : {'name' : 'reviewer'}}]})
+            change = {'project' : 'demo', 'id' : 'I%040d' %(i), 'owner' : {'name' : 'owner%d' %(i % 7)}, 'sortKey' : '%016x' %(t + 50),
+                      'status' : ['MERGED', 'ABANDONED'][i % 10 == 0], 'createdOn' : t, 'lastUpdated' : t + 50, 'patchSets' : patchSets}
+            fh.write(json.dumps(change, separators = (',', ':')) + '\n')
+        fh.write(json.dumps({'type' : 'stats', 'rowCount' : count}) + '\n')
+
+def benchmarkParse(filePath, resultPath):
+    '''Print records/second of parsing a dump and of writing the CSV'''
+    with open(filePath) as fh:
+        count = sum([1 for line in fh])
+    reviewer = GitLogReviewer(0)
+    start = time.time()
+    reviewer.loadFromFile(filePath)
+    reviewer.parseAllRecords()
+    cost1 = time.time() - start
+    start = time.time()
+    reviewer.save2File(resultPath, True)
+    cost2 = time.time() - start
+    print '[benchmarkParse] parse: %.0f records/s, parse+save: %.0f records/s' %(count / cost1, count / (cost1 + cost2))
 
     
 #######Executing Section#########
@@ -300,7 +787,16 @@ if __name__ == '__main__':
     reviewer.loopProcessCmd(my_git_cfg, 'git_result.csv')
     #reviewer.processCmd(my_git_cfg, 'result_loop_cfg_new2.csv')
     #reviewer.loopProcessCmd(None, 'result_loop_def.csv')
+    #reviewer.loopProcessCmd(my_git_cfg, 'git_result.csv', True)
+    #reviewer.pipeProcessCmd(my_git_cfg, 'git_result.csv')
+    #reviewer.incrementalProcessCmd(my_git_cfg, 'git_result.csv')
+    #store = ChangeStore()
+    #GitLogReviewer(400, store).processFile('origin_result', 'result3.csv')
+    #store.outputStats()
+    #makeSyntheticDump('synthetic_dump', 100000)
+    #benchmarkParse('synthetic_dump', 'synthetic_result.csv')
     #reviewer.processFile('origin_result', 'result3.csv')
+    #reviewer.parallelProcessFile('origin_result', 'result3.csv')
     #reviewer.loadGitCfg('../cfg.txt')
     #reviewer.loadGitCfg2('../cfg.txt')
 
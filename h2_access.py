@@ -9,31 +9,353 @@
 #       Url: https://pypi.python.org/pypi/JayDeBeApi/#usage
 #       Install: yum install python-devel.x86_64
 #                pip install JayDeBeApi
+# Set db_backend to 'sqlite' to keep the nodes in a local sqlite3 file instead,
+# which needs neither H2 nor a JVM. './h2_access.py m' copies table 'nodes'
+# from H2 to sqlite.
 '''
 
 
-import jaydebeapi as J
+import os
+import sqlite3
+import csv
+import json
+import time
+import atexit
+import Queue
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
   
 
 db_name = 'led'
 db_user = 'led'
 db_pswd = 'bmc'
 db_table = 'nodes'
+db_backend = 'h2'  # 'h2' or 'sqlite'
+sqlite_path = os.path.expanduser('~/%s.sqlite' %(db_name))
 
-def run_sql(cmd, needResult):
-    conn = J.connect('org.h2.Driver', ['jdbc:h2:~/%s' %(db_name), db_user, db_pswd], '/path/to/hsqldb.jar',)
-    curs = conn.cursor()
-    #print 'function run_sql command:', cmd
-    curs.execute(cmd)
-    if needResult:
-        result =  curs.fetchall()
-        conn.close()
-        return result
-    else:
-        conn.commit()
-        conn.close()
+def new_connection():
+    #imported here so that the sqlite backend never loads jaydebeapi and the JVM
+    import jaydebeapi as J
+    return J.connect('org.h2.Driver', ['jdbc:h2:~/%s' %(db_name), db_user, db_pswd], '/path/to/hsqldb.jar',)
+
+class pool_class:
+    '''
+        Process-wide pool of JDBC connections to DB 'led'.
+        Connections are opened on first use and reused by every later statement,
+        so the H2 driver is loaded and the connection set up only once.
+        All pooled connections are closed when the process exits.
+    '''
+
+    def __init__(self, max_size=4):
+        self.max_size = max_size
+        self.idle = Queue.LifoQueue()
+        self.opened = []
+
+    @contextmanager
+    def connection(self):
+        try:
+            conn = self.idle.get_nowait()
+        except Queue.Empty:
+            conn = new_connection()
+            self.opened.append(conn)
+        healthy = True
+        try:
+            yield conn
+        except BaseException:
+            #also GeneratorExit, when the caller of iter_sql stops early
+            try:
+                conn.rollback()
+            except Exception:
+                #the connection is broken, do not hand it out again
+                healthy = False
+            raise
+        finally:
+            if healthy and self.idle.qsize() < self.max_size:
+                self.idle.put(conn)
+            else:
+                self.opened.remove(conn)
+                try:
+                    conn.close()
+                except Exception:
+                    pass
+
+    def close(self):
+        while self.opened:
+            try:
+                self.opened.pop().close()
+            except Exception:
+                pass
+        self.idle = Queue.LifoQueue()
+
+db_pool = pool_class()
+atexit.register(db_pool.close)
+
+def run_sql(cmd, needResult, params=None):
+    '''
+        params are bound to the '?' placeholders of cmd
+    '''
+    with db_pool.connection() as conn:
+        curs = conn.cursor()
+        try:
+            #print 'function run_sql command:', cmd
+            if params is None:
+                curs.execute(cmd)
+            else:
+                curs.execute(cmd, params)
+            if needResult:
+                return curs.fetchall()
+            else:
+                conn.commit()
+        finally:
+            curs.close()
+
+def run_many(cmd, rows, batch_size=500):
+    '''
+        Execute the prepared statement cmd once per row of parameters.
+        Rows are sent with executemany() and committed every batch_size rows.
+        Return the number of rows executed.
+    '''
+    count = 0
+    with db_pool.connection() as conn:
+        curs = conn.cursor()
+        try:
+            batch = []
+            for row in rows:
+                batch.append(tuple(row))
+                if len(batch) >= batch_size:
+                    curs.executemany(cmd, batch)
+                    conn.commit()
+                    count += len(batch)
+                    batch = []
+            if batch:
+                curs.executemany(cmd, batch)
+                conn.commit()
+                count += len(batch)
+        finally:
+            curs.close()
+    return count
+
+def iter_sql(cmd, params=None, batch_size=500):
+    '''
+        Generator over the result rows of cmd, fetched batch_size rows at a time.
+        The connection stays checked out of the pool until the generator ends.
+    '''
+    with db_pool.connection() as conn:
+        curs = conn.cursor()
+        try:
+            if params is None:
+                curs.execute(cmd)
+            else:
+                curs.execute(cmd, params)
+            while True:
+                rows = curs.fetchmany(batch_size)
+                if not rows:
+                    break
+                for row in rows:
+                    yield row
+        finally:
+            curs.close()
     
 
+########################################
+#   Storage backends
+########################################
+
+class h2_backend:
+    '''
+        Table 'nodes' in H2, through the pooled run_sql/run_many above.
+    '''
+    create_cmd = "CREATE TABLE %s(name VARCHAR(100) PRIMARY KEY, ip VARCHAR(100), usr VARCHAR(100), pwd VARCHAR(100), grp VARCHAR(100), desc VARCHAR(255))"
+    merge_cmd = "MERGE INTO %s KEY(name) VALUES(?, ?, ?, ?, ?, ?)"
+
+    def run_sql(self, cmd, needResult, params=None):
+        return run_sql(cmd, needResult, params)
+
+    def run_many(self, cmd, rows, batch_size=500):
+        return run_many(cmd, rows, batch_size)
+
+    def iter_sql(self, cmd, params=None, batch_size=500):
+        return iter_sql(cmd, params, batch_size)
+
+class sqlite_backend:
+    '''
+        Table 'nodes' in a local sqlite3 file. One connection per process,
+        opened on first use and shared by all threads under a lock.
+    '''
+    create_cmd = 'CREATE TABLE IF NOT EXISTS %s(name VARCHAR(100) PRIMARY KEY, ip VARCHAR(100), usr VARCHAR(100), pwd VARCHAR(100), grp VARCHAR(100), "desc" VARCHAR(255))'
+    merge_cmd = "INSERT OR REPLACE INTO %s VALUES(?, ?, ?, ?, ?, ?)"
+
+    def __init__(self, path=sqlite_path):
+        self.path = path
+        self.conn = None
+        self.lock = threading.RLock()
+
+    def connection(self):
+        if self.conn is None:
+            self.conn = sqlite3.connect(self.path, check_same_thread=False)
+            atexit.register(self.conn.close)
+        return self.conn
+
+    def run_sql(self, cmd, needResult, params=None):
+        with self.lock:
+            conn = self.connection()
+            try:
+                curs = conn.execute(cmd, params or ())
+                if needResult:
+                    return curs.fetchall()
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+
+    def run_many(self, cmd, rows, batch_size=500):
+        count = 0
+        with self.lock:
+            conn = self.connection()
+            batch = []
+            try:
+                for row in rows:
+                    batch.append(tuple(row))
+                    if len(batch) >= batch_size:
+                        conn.executemany(cmd, batch)
+                        conn.commit()
+                        count += len(batch)
+                        batch = []
+                if batch:
+                    conn.executemany(cmd, batch)
+                    conn.commit()
+                    count += len(batch)
+            except Exception:
+                conn.rollback()
+                raise
+        return count
+
+    def iter_sql(self, cmd, params=None, batch_size=500):
+        #only the fetch of each batch holds the lock, not the caller's loop
+        with self.lock:
+            curs = self.connection().cursor()
+        try:
+            with self.lock:
+                curs.execute(cmd, params or ())
+            while True:
+                with self.lock:
+                    rows = curs.fetchmany(batch_size)
+                if not rows:
+                    break
+                for row in rows:
+                    yield row
+        finally:
+            with self.lock:
+                curs.close()
+
+def get_backend(name):
+    if name == 'sqlite':
+        return sqlite_backend()
+    return h2_backend()
+
+
+class cache_class:
+    '''
+        LRU cache with a time-to-live per entry.
+        With snapshot_path the entries are also kept in that file (mode 0600),
+        so that a new process can answer lookups without connecting to H2.
+        New entries are merged into the file at most every save_interval seconds
+        and at exit, invalidations are written through at once.
+    '''
+
+    def __init__(self, max_size=1024, ttl=300, snapshot_path=None, save_interval=30):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.snapshot_path = snapshot_path
+        self.save_interval = save_interval
+        self.entries = OrderedDict() # key -> (expire time, value)
+        self.pending = set()         # keys put since the last save
+        self.saved_at = time.time()
+        self.lock = threading.Lock()
+        if snapshot_path is not None:
+            self._load()
+            atexit.register(self.flush)
+
+    def _read(self):
+        try:
+            with open(self.snapshot_path) as fh:
+                return json.load(fh)
+        except (IOError, ValueError):
+            return []
+
+    def _load(self):
+        now = time.time()
+        for (key, expire, value) in self._read()[-self.max_size:]:
+            if expire > now:
+                self.entries[key] = (expire, [tuple(row) for row in value])
+
+    def _save(self, removed=(), clear=False):
+        '''
+            Merge the file on disk with the pending entries, minus the removed
+            keys. Entries other processes wrote or dropped are kept that way.
+        '''
+        now = time.time()
+        merged = OrderedDict()
+        if not clear:
+            for (key, expire, value) in self._read():
+                if expire > now and key not in removed:
+                    merged[key] = (expire, value)
+        for key in self.pending:
+            item = self.entries.get(key)
+            if item is not None:
+                merged.pop(key, None)
+                merged[key] = item
+        while len(merged) > self.max_size:
+            merged.popitem(last=False)
+        tmp_path = '%s.%d.tmp' %(self.snapshot_path, os.getpid())
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600)
+        with os.fdopen(fd, 'w') as fh:
+            json.dump([(key, item[0], item[1]) for (key, item) in merged.items()], fh)
+        os.rename(tmp_path, self.snapshot_path)
+        self.pending.clear()
+        self.saved_at = now
+
+    def flush(self):
+        with self.lock:
+            if self.snapshot_path is not None and self.pending:
+                self._save()
+
+    def get(self, key):
+        with self.lock:
+            item = self.entries.pop(key, None)
+            if item is None or item[0] < time.time():
+                return None
+            self.entries[key] = item
+            return item[1]
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (time.time() + self.ttl, value)
+            while len(self.entries) > self.max_size:
+                self.pending.discard(self.entries.popitem(last=False)[0])
+            if self.snapshot_path is None:
+                return
+            self.pending.add(key)
+            if time.time() - self.saved_at >= self.save_interval:
+                self._save()
+
+    def invalidate(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.pending.discard(key)
+            if self.snapshot_path is not None:
+                self._save(removed=(key,))
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.pending.clear()
+            if self.snapshot_path is not None:
+                self._save(clear=True)
+
+
 ########################################
 #   Operations on TABLE 'nodes'
 ########################################
@@ -44,57 +366,130 @@ class nodes_class:
         Before using it, make sure database 'led' is already created.
         Table 'nodes' structure:
         | name(PK) | ip | usr | pwd | grp | desc |
+        Results of get_record are cached, see cache_class.
+        The table lives in H2 by default, or in any other backend, see sqlite_backend.
     '''
     
-    def __init__(self):
-        None
+    def __init__(self, cache_size=1024, cache_ttl=300, snapshot_path=None, backend=None):
+        self.cache = cache_class(cache_size, cache_ttl, snapshot_path)
+        if backend is None:
+            backend = get_backend(db_backend)
+        self.backend = backend
 
     def create_table(self):
-        cmd = "CREATE TABLE %s(%s VARCHAR(100) PRIMARY KEY, %s VARCHAR(100), %s VARCHAR(100), %s VARCHAR(100), %s VARCHAR(100), %s VARCHAR(255))" %(db_table, 'name', 'ip', 'usr', 'pwd', 'grp', 'desc')
-        run_sql(cmd, False)
+        cmd = self.backend.create_cmd %(db_table)
+        self.backend.run_sql(cmd, False)
+        self.create_indexes()
+        self.cache.clear()
+
+    def create_indexes(self):
+        '''
+            Secondary indexes for the lookups by group and by ip prefix
+        '''
+        for column in ('grp', 'ip'):
+            cmd = "CREATE INDEX IF NOT EXISTS %s_%s_idx ON %s(%s)" %(db_table, column, db_table, column)
+            self.backend.run_sql(cmd, False)
 
     def drop_table(self):
         cmd = "DROP TABLE %s" %(db_table)
-        run_sql(cmd, False)
+        self.backend.run_sql(cmd, False)
+        self.cache.clear()
 
     def add_record(self, name, ip, user, pwd, group, desc):
-        cmd = "INSERT INTO %s VALUES('%s', '%s', '%s', '%s', '%s', '%s')" %(db_table, name, ip, user, pwd, group, desc)
-        run_sql(cmd, False)
+        cmd = "INSERT INTO %s VALUES(?, ?, ?, ?, ?, ?)" %(db_table)
+        self.backend.run_sql(cmd, False, (name, ip, user, pwd, group, desc))
+        self.cache.invalidate(name)
         #print 'after add:', run_sql("select * from %s" %(db_table), True) 
 
+    def add_records(self, records, batch_size=500):
+        '''
+            Bulk insert of (name, ip, user, pwd, group, desc) rows
+        '''
+        cmd = "INSERT INTO %s VALUES(?, ?, ?, ?, ?, ?)" %(db_table)
+        try:
+            return self.backend.run_many(cmd, records, batch_size)
+        finally:
+            self.cache.clear()
+
+    def merge_records(self, records, batch_size=500):
+        '''
+            Bulk upsert of (name, ip, user, pwd, group, desc) rows, keyed by name
+        '''
+        cmd = self.backend.merge_cmd %(db_table)
+        try:
+            return self.backend.run_many(cmd, records, batch_size)
+        finally:
+            self.cache.clear()
+
     def update_record(self, name, ip, user, pwd, group, desc):
-        result = self.get_record(name)
-        if len(result) == 0:
-            print 'No such record exists:', name, '. Will add a new record'
-            self.add_record(name, ip, user, pwd, group, desc)
-        else:
-            print 'The record already exists:', result
-            cmd = "UPDATE %s SET ip='%s', usr='%s', pwd='%s', grp='%s', desc='%s' WHERE name='%s'" %(db_table, ip, user, pwd, group, desc, name)
-            run_sql(cmd, False)
+        cmd = self.backend.merge_cmd %(db_table)
+        try:
+            self.backend.run_sql(cmd, False, (name, ip, user, pwd, group, desc))
+        finally:
+            self.cache.invalidate(name)
         #print 'after add:', run_sql("select * from %s" %(db_table), True)
 
     def get_record(self, name):
-        cmd = "select usr, ip, pwd from %s where name='%s'" %(db_table, name)
-        result = run_sql(cmd, True)
+        result = self.cache.get(name)
+        if result is not None:
+            return result
+        cmd = "select usr, ip, pwd from %s where name=?" %(db_table)
+        result = self.backend.run_sql(cmd, True, (name,))
         #print 'get_record:', result
+        if result:
+            self.cache.put(name, [tuple(row) for row in result])
         return result
 
+    def iter_records(self, batch_size=500):
+        '''
+            Generator over all rows (name, ip, usr, pwd, grp, desc), ordered by name
+        '''
+        cmd = "SELECT * FROM %s ORDER BY name" %(db_table)
+        return self.backend.iter_sql(cmd, None, batch_size)
+
+    def iter_by_group(self, group, batch_size=500):
+        cmd = "SELECT * FROM %s WHERE grp=? ORDER BY name" %(db_table)
+        return self.backend.iter_sql(cmd, (group,), batch_size)
+
+    def get_by_group(self, group):
+        return list(self.iter_by_group(group))
+
+    def iter_by_ip_prefix(self, prefix, batch_size=500):
+        '''
+            Rows whose ip starts with prefix, e.g. '10.175.183.'.
+            Written as a range on ip so that the ip index is used.
+        '''
+        if prefix == '':
+            return self.iter_records(batch_size)
+        upper = prefix[:-1] + unichr(ord(prefix[-1]) + 1)
+        cmd = "SELECT * FROM %s WHERE ip>=? AND ip<? ORDER BY ip" %(db_table)
+        return self.backend.iter_sql(cmd, (prefix, upper), batch_size)
+
+    def get_by_ip_prefix(self, prefix):
+        return list(self.iter_by_ip_prefix(prefix))
+
     def delete_record(self, name):
-        cmd = "delete from %s where name='%s'" %(db_table, name)
-        run_sql(cmd, False)
+        cmd = "delete from %s where name=?" %(db_table)
+        try:
+            self.backend.run_sql(cmd, False, (name,))
+        finally:
+            self.cache.invalidate(name)
         #print 'after add:', run_sql("select * from %s" %(db_table), True)
 
 
 ##################################################
 #   Function Area
 ##################################################
-nodes_instance = nodes_class()
+nodes_instance = nodes_class(snapshot_path=os.path.expanduser('~/.%s_%s_snapshot' %(db_name, db_table)))
 
 def print_usage():
     print 'Usage:'
     print '  ./h2_access.py u name ip user pwd group desc'
     print '  ./h2_access.py g name'
-    print '  ./h2_access.py d name\n'
+    print '  ./h2_access.py d name'
+    print '  ./h2_access.py l group'
+    print '  ./h2_access.py i file.csv    (rows of: name,ip,user,pwd,group,desc)'
+    print '  ./h2_access.py m             (copy table from H2 to %s)\n' %(sqlite_path)
 
 def update_record(p):
     if len(p) != 8:
@@ -116,6 +511,32 @@ def get_records(p):
             print 'get_record:', (user, ip, pwd)
             #return 'ssh %s@%s' %(user, ip)
 
+def list_group(p):
+    if len(p) != 3:
+        print_usage()
+    else:
+        for row in nodes_instance.iter_by_group(p[2]):
+            print '%s %s@%s' %(row[0], row[2], row[1])
+
+def import_records(p):
+    if len(p) != 3:
+        print_usage()
+    else:
+        with open(p[2]) as fh:
+            rows = [row for row in csv.reader(fh) if len(row) == 6]
+        count = nodes_instance.merge_records(rows)
+        print 'import_records: %d records merged from %s' %(count, p[2])
+
+def migrate_to_sqlite(p):
+    '''
+        One-shot copy of table 'nodes' from H2 into the sqlite file
+    '''
+    rows = h2_backend().run_sql("SELECT * FROM %s" %(db_table), True)
+    target = nodes_class(backend=sqlite_backend())
+    target.create_table()
+    count = target.merge_records([tuple(row) for row in rows])
+    print 'migrate_to_sqlite: %d records copied to %s' %(count, sqlite_path)
+
 def delete_record(p):
     if len(p) != 3:
         print_usage()
@@ -136,10 +557,30 @@ def test_sql():
     #run_sql("delete from nodes where name='201'", False)
     #print 'after delete:', run_sql("select * from nodes", True)
     
+    #benchmark_lookup('201', 10000)
     #run_sql("DROP TABLE nodes", False)
     #run_sql("CREATE TABLE %s(%s VARCHAR(100) PRIMARY KEY, %s VARCHAR(100), %s VARCHAR(100), %s VARCHAR(100), %s VARCHAR(100), %s VARCHAR(255))" %(db_table, 'name', 'ip', 'usr', 'pwd', 'grp', 'desc'), False)
 
 
+def benchmark_lookup(name, count=10000):
+    cmd = "select usr, ip, pwd from %s where name='%s'" %(db_table, name)
+    start = time.time()
+    for i in range(count):
+        conn = new_connection()
+        curs = conn.cursor()
+        curs.execute(cmd)
+        curs.fetchall()
+        conn.close()
+    cost1 = time.time() - start
+    print 'Connect per lookup, %d lookups total time cost: %s' %(count, cost1)
+
+    start = time.time()
+    for i in range(count):
+        run_sql(cmd, True)
+    cost2 = time.time() - start
+    print 'Pooled connection, %d lookups total time cost: %s' %(count, cost2)
+
+
 ##################################################
 #   Main Area
 ##################################################
@@ -149,7 +590,10 @@ if __name__ != '__main__':
     operations = {
         'u' : lambda : update_record(sys.argv),
         'g' : lambda : get_records(sys.argv),
-        'd' : lambda : delete_record(sys.argv),    
+        'd' : lambda : delete_record(sys.argv),
+        'l' : lambda : list_group(sys.argv),
+        'i' : lambda : import_records(sys.argv),
+        'm' : lambda : migrate_to_sqlite(sys.argv),    
     }
 
     if len(sys.argv) > 1 and sys.argv[1] in operations.keys():
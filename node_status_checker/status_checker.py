@@ -4,15 +4,22 @@ Created on Dec 23, 2015
 '''
 
 import os
+import csv
 import json
 import time
+import heapq
+import bisect
+import random
+import errno
+import select
 import signal
+import pipes
 import threading
 import logging
 import ConfigParser
 import subprocess
 from multiprocessing.pool import ThreadPool
-from datetime import datetime
+from collections import deque
 
 
 #=============================common functions======
@@ -38,26 +45,115 @@ def run_cmd1(cmd):
 
 def run_cmd2(cmd):
     '''Use subprocess.popen() to run commands'''
-    timeout = 10
-    start = datetime.now()
-    
-    result = None
     print 'Run command:', cmd
-    try:
-        p = subprocess.Popen(cmd, shell=True, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
-        while p.poll() is None:
-            time.sleep(0.2)
-            now = datetime.now()
-            if (now - start).seconds > timeout:
-                os.kill(p.pid, signal.SIGKILL)
-                os.waitpid(-1, os.WNOHANG)
-                print 'timeout for cmd:', cmd
-                return None
-        (result, err) = p.communicate(cmd)
-        #print result
-    except Exception, ex:
-        print '[run_cmd] Exception:', ex
-    return result.strip()
+    for (_, result, _) in CmdRunner(timeout=10).run([cmd]):
+        return result
+
+class CmdRunner():
+    '''Run many shell commands concurrently on one thread.
+       The stdout pipes of all running commands are multiplexed with select.poll(),
+       so there is neither a sleep loop nor a thread per command. Every command gets
+       its own process group, a timeout kills the whole group (ssh and children).
+       run() drives a fixed list of commands; a long-lived caller can instead
+       start() commands at any time and collect them with poll().
+    '''
+    def __init__(self, timeout=10, concurrency=500, keep_partial=False):
+        self.timeout = timeout
+        self.concurrency = concurrency
+        self.keep_partial = keep_partial
+        self.running = {} # fd -> [index, process, chunks, start, cmd]
+        self.poller = select.poll()
+        self.devnull = None
+
+    def _kill(self, p):
+        try:
+            os.killpg(p.pid, signal.SIGKILL)
+        except OSError:
+            pass
+        p.stdout.close()
+        p.wait()
+
+    def start(self, index, cmd):
+        '''Spawn cmd, poll() returns its result under index. False if it could not be spawned'''
+        if self.devnull is None:
+            self.devnull = open(os.devnull, 'r')
+        try:
+            p = subprocess.Popen(cmd, shell=True, stdin=self.devnull, stdout=subprocess.PIPE, preexec_fn=os.setsid)
+        except Exception, ex:
+            print '[run_cmd] Exception:', ex
+            return False
+        fd = p.stdout.fileno()
+        self.running[fd] = [index, p, [], time.time(), cmd]
+        self.poller.register(fd, select.POLLIN | select.POLLPRI)
+        return True
+
+    def poll(self, max_wait=None):
+        '''Wait for output up to max_wait seconds (None: until a command finishes
+           or times out), return [(index, result, cost)] of the commands done.
+           result is the stripped stdout, or None on timeout. With keep_partial
+           a timed out command returns what it printed so far.
+        '''
+        done = []
+        if not self.running:
+            if max_wait:
+                time.sleep(max_wait)
+            return done
+        wait = min([item[3] for item in self.running.values()]) + self.timeout - time.time()
+        if max_wait is not None:
+            wait = min(wait, max_wait)
+        try:
+            events = self.poller.poll(max(wait, 0) * 1000)
+        except select.error, ex:
+            if ex.args[0] != errno.EINTR:
+                raise
+            events = []
+        ready = set()
+        for (fd, event) in events:
+            item = self.running[fd]
+            data = os.read(fd, 65536)
+            if data:
+                item[2].append(data)
+                ready.add(fd)
+                continue
+            self.poller.unregister(fd)
+            del self.running[fd]
+            item[1].stdout.close()
+            item[1].wait()
+            done.append((item[0], ''.join(item[2]).strip(), time.time() - item[3]))
+
+        now = time.time()
+        #a command that already exited but still has output to drain is not a timeout
+        for fd in [fd for fd in self.running if now - self.running[fd][3] > self.timeout and (fd not in ready or self.running[fd][1].poll() is None)]:
+            item = self.running.pop(fd)
+            self.poller.unregister(fd)
+            self._kill(item[1])
+            print 'timeout for cmd:', item[4]
+            done.append((item[0], ''.join(item[2]).strip() if self.keep_partial else None, now - item[3]))
+        return done
+
+    def close(self):
+        '''Kill whatever is still running'''
+        for item in self.running.values():
+            self._kill(item[1])
+        self.running.clear()
+        self.poller = select.poll()
+        if self.devnull is not None:
+            self.devnull.close()
+            self.devnull = None
+
+    def run(self, cmds):
+        '''Generator, yields (index, result, cost) in completion order, see poll()'''
+        todo = deque(enumerate(cmds))
+        try:
+            while todo or self.running:
+                while todo and len(self.running) < self.concurrency:
+                    (index, cmd) = todo.popleft()
+                    if not self.start(index, cmd):
+                        yield (index, None, 0.0)
+                for item in self.poll():
+                    yield item
+        finally:
+            self.close()
         
 def pool_run_cmds(cmds):
     pool = ThreadPool(4)
@@ -66,6 +162,58 @@ def pool_run_cmds(cmds):
     pool.join()
     print results
 
+#=============================result records======
+class CheckRecorder():
+    '''Collect one record per check result and summarise the latencies.
+       Records are kept in memory and written in one go by save(), as JSON lines
+       or CSV depending on the file extension.
+    '''
+    FIELDS = ['node', 'check', 'expected', 'actual', 'ok', 'duration', 'timestamp']
+    BUCKETS = [0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+    def __init__(self):
+        self.records = []
+
+    def record(self, node, check, expected, actual, duration, timestamp=None):
+        if timestamp is None:
+            timestamp = time.time()
+        self.records.append({'node': node, 'check': check, 'expected': expected, 'actual': actual,
+                             'ok': actual == expected, 'duration': round(duration, 3), 'timestamp': timestamp})
+
+    def save(self, file_path):
+        with open(file_path, 'wb') as f:
+            if file_path.endswith('.csv'):
+                writer = csv.DictWriter(f, self.FIELDS)
+                writer.writeheader()
+                writer.writerows(self.records)
+            else:
+                f.write(''.join([json.dumps(item) + '\n' for item in self.records]))
+        print 'Saved %d records to %s' %(len(self.records), file_path)
+
+    def _histogram(self, key):
+        groups = {}
+        for item in self.records:
+            groups.setdefault(item[key], []).append(item)
+        lines = []
+        for name in sorted(groups):
+            costs = sorted([item['duration'] for item in groups[name]])
+            nok = len([item for item in groups[name] if not item['ok']])
+            counts = [0] * (len(self.BUCKETS) + 1)
+            for cost in costs:
+                counts[bisect.bisect_left(self.BUCKETS, cost)] += 1
+            buckets = ' '.join(['<=%s:%d' %(b, c) for (b, c) in zip(self.BUCKETS, counts)] + ['>%s:%d' %(self.BUCKETS[-1], counts[-1])])
+            lines.append('%s n=%d nok=%d min=%.2f avg=%.2f p50=%.2f p95=%.2f max=%.2f  %s' %(name.ljust(25), len(costs), nok,
+                         costs[0], sum(costs) / len(costs), costs[len(costs) / 2], costs[min(len(costs) * 95 / 100, len(costs) - 1)], costs[-1], buckets))
+        return lines
+
+    def print_summary(self):
+        print '\nLATENCY BY CHECK'
+        for line in self._histogram('check'):
+            print line
+        print '\nLATENCY BY NODE'
+        for line in self._histogram('node'):
+            print line
+
 #===================load config with ConfigParser==============================
 class ConfigLoader():
     nodes = {}
@@ -133,6 +281,8 @@ class ConfigLoader():
         #print self.candidate_cmds
         
 #===================load config with json==============================
+BATCH_BEGIN = '#@@CHECK-BEGIN@@'
+BATCH_END = '#@@CHECK-END@@'
 class JsonConfigLoader():
     nodes = {}
     candidate_cmds = {}
@@ -149,24 +299,94 @@ class JsonConfigLoader():
                 self.candidate_cmds[item] = data[item]
         #print self.nodes
         #print self.candidate_cmds
-    def run_and_check(self, param):
+    def _build_cmd(self, param):
+        (node_name, cmd_name) = param.split(';')
+        return 'ssh %s "%s"' %(self.nodes[node_name], self.candidate_cmds[cmd_name]['cmd'])
+    def _check_result(self, param, result):
         (node_name, cmd_name) = param.split(';')
-        cmd = 'ssh %s "%s"' %(self.nodes[node_name], self.candidate_cmds[cmd_name]['cmd'])
         exp = self.candidate_cmds[cmd_name]['expect']
-        result = run_cmd2(cmd)
         if result == exp:
             return '%s;'.ljust(8-len(node_name)) %(node_name) + '%s;'.ljust(25-len(cmd_name)) %(cmd_name) + self.candidate_cmds[cmd_name]['true']
             #return node_name.ljust(10) + ";"  + cmd_name.ljust(20) + ";" + self.candidate_cmds[cmd_name]['true']
         else:
             return '%s;'.ljust(8-len(node_name)) %(node_name) + '"%s;'.ljust(25-len(cmd_name)) %(cmd_name) + self.candidate_cmds[cmd_name]['false']
-    def multi_run_and_check(self, params):
-        pool = ThreadPool(4)
-        results = pool.map(self.run_and_check, params)
+    def run_and_check(self, param):
+        result = run_cmd2(self._build_cmd(param))
+        return self._check_result(param, result)
+    def _timed_run(self, param):
+        start = time.time()
+        result = run_cmd2(self._build_cmd(param))
+        return (param, result, time.time() - start)
+    def multi_run_and_check(self, params, concurrency=4, recorder=None):
+        '''Print each result as soon as its check finishes'''
+        pool = ThreadPool(concurrency)
+        print 'NODE'.ljust(6) + 'COMMAND'.ljust(23) + 'RESULT'
+        for (param, result, cost) in pool.imap_unordered(self._timed_run, params):
+            self._record(recorder, param, result, cost)
+            print self._check_result(param, result)
         pool.close()
         pool.join()
+        self._summary(recorder)
+    def _record(self, recorder, param, result, cost):
+        if recorder is not None:
+            (node_name, cmd_name) = param.split(';')
+            recorder.record(node_name, cmd_name, self.candidate_cmds[cmd_name]['expect'], result, cost)
+    def _summary(self, recorder):
+        if recorder is not None:
+            recorder.print_summary()
+    def loop_run_and_check(self, params, timeout=10, concurrency=500, recorder=None):
+        '''Same checks as multi_run_and_check, but all ssh commands are driven
+           from one CmdRunner event loop instead of a thread per command'''
+        runner = CmdRunner(timeout, concurrency)
+        print 'NODE'.ljust(6) + 'COMMAND'.ljust(23) + 'RESULT'
+        for (index, result, cost) in runner.run([self._build_cmd(param) for param in params]):
+            self._record(recorder, params[index], result, cost)
+            print self._check_result(params[index], result)
+        self._summary(recorder)
+    def _build_batch_cmd(self, node_name, cmd_names):
+        '''One ssh command running all checks of a node, every check output is
+           framed by begin/end markers and the end marker carries its exit code'''
+        script = []
+        for cmd_name in cmd_names:
+            script.append('echo %s; ( %s ) </dev/null; rc=$?; echo; echo %s"$rc"' %(pipes.quote('%s %s' %(BATCH_BEGIN, cmd_name)),
+                self.candidate_cmds[cmd_name]['cmd'], pipes.quote('%s %s ' %(BATCH_END, cmd_name))))
+        return 'ssh %s %s' %(self.nodes[node_name], pipes.quote('\n'.join(script)))
+    def _split_batch_result(self, output):
+        '''Return {cmd_name: (exit_code, output)} for every check that finished'''
+        results = {}
+        current = None
+        for line in (output or '').split('\n'):
+            if line.startswith(BATCH_BEGIN + ' '):
+                current = line[len(BATCH_BEGIN) + 1:]
+                lines = []
+            elif line.startswith(BATCH_END + ' ') and current is not None:
+                #the check name may contain blanks, the exit code is the last word
+                (cmd_name, rc) = line[len(BATCH_END) + 1:].rsplit(' ', 1)
+                if cmd_name == current:
+                    results[cmd_name] = (int(rc), '\n'.join(lines).strip())
+                current = None
+            elif current is not None:
+                lines.append(line)
+        return results
+    def batch_run(self, node_names, timeout=30, concurrency=500):
+        '''Generator, runs all candidate commands of a node in one ssh round trip
+           and yields (param, result, exit_code, cost) per check. result and
+           exit_code are None when the check did not finish.'''
+        cmd_names = sorted(self.candidate_cmds.keys())
+        runner = CmdRunner(timeout, concurrency, keep_partial=True)
+        for (index, output, cost) in runner.run([self._build_batch_cmd(node_name, cmd_names) for node_name in node_names]):
+            results = self._split_batch_result(output)
+            for cmd_name in cmd_names:
+                (rc, result) = results.get(cmd_name, (None, None))
+                yield ('%s;%s' %(node_names[index], cmd_name), result, rc, cost)
+    def batch_run_and_check(self, node_names, timeout=30, concurrency=500, recorder=None):
+        '''Same output as multi_run_and_check with one ssh connection per node.
+           The recorded duration is the round trip of the whole node.'''
         print 'NODE'.ljust(6) + 'COMMAND'.ljust(23) + 'RESULT'
-        for item in results:
-            print item
+        for (param, result, rc, cost) in self.batch_run(node_names, timeout, concurrency):
+            self._record(recorder, param, result, cost)
+            print self._check_result(param, result)
+        self._summary(recorder)
     def _write_file(self, config_file):
         ss = {
         'check-event-port' : 
@@ -215,6 +435,94 @@ def check_all_nodes():
         t.join(100)
     print 'Finished checking the status of all nodes'
 
+#=============================continuous monitor======
+class StatusMonitor():
+    '''Keep checking every (node, check) pair on its own interval.
+       The interval comes from the optional "interval" field of a check in the json
+       config. All pairs share one long-lived CmdRunner: a pair is started as soon
+       as it is due and rescheduled interval * (1 +- jitter) seconds after it
+       finishes, so a slow check never holds back the others and the checks
+       spread out instead of hitting all nodes at once.
+       The last result and latency of every pair are kept in self.status, and only
+       state changes (e.g. OK -> NOK) are printed. With a recorder every result is
+       recorded, and the summary is printed when run() stops.
+    '''
+    def __init__(self, loader, default_interval=60, jitter=0.1, timeout=10, concurrency=500, recorder=None):
+        self.loader = loader
+        self.recorder = recorder
+        self.default_interval = default_interval
+        self.jitter = jitter
+        self.timeout = timeout
+        self.concurrency = concurrency
+        self.status = {}     # param -> {'ok', 'result', 'cost', 'time'}
+        self._schedule = []  # heap of (due time, param)
+        self.runner = CmdRunner(timeout, concurrency)
+        self._running = {}   # runner index -> param
+        self._index = 0
+
+    def _interval(self, param):
+        cmd_name = param.split(';')[1]
+        return float(self.loader.candidate_cmds[cmd_name].get('interval', self.default_interval))
+
+    def _update(self, param, result, cost, now):
+        (node_name, cmd_name) = param.split(';')
+        check = self.loader.candidate_cmds[cmd_name]
+        ok = (result == check['expect'])
+        self.loader._record(self.recorder, param, result, cost)
+        old = self.status.get(param)
+        self.status[param] = {'ok': ok, 'result': result, 'cost': cost, 'time': now}
+        if old is not None and old['ok'] == ok:
+            return
+        before = '-' if old is None else check['true' if old['ok'] else 'false']
+        after = check['true' if ok else 'false']
+        print '%s %s;%s;%s -> %s (%.2fs)' %(time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(now)), node_name, cmd_name, before, after, cost)
+
+    def schedule(self, params):
+        '''Spread the first run of every pair over its interval'''
+        now = time.time()
+        self._schedule = [(now + random.uniform(0, self._interval(param)), param) for param in params]
+        heapq.heapify(self._schedule)
+
+    def _finish(self, param, result, cost):
+        finished = time.time()
+        self._update(param, result, cost, finished)
+        interval = self._interval(param)
+        heapq.heappush(self._schedule, (finished + interval * random.uniform(1 - self.jitter, 1 + self.jitter), param))
+
+    def run_once(self, block=False):
+        '''Start every pair that is due, then collect the pairs that finished and
+           reschedule each of them. With block, wait until a pair finishes or the
+           next one is due. Return the number of pairs finished.
+        '''
+        now = time.time()
+        while self._schedule and self._schedule[0][0] <= now and len(self.runner.running) < self.concurrency:
+            param = heapq.heappop(self._schedule)[1]
+            self._index += 1
+            if self.runner.start(self._index, self.loader._build_cmd(param)):
+                self._running[self._index] = param
+            else:
+                self._finish(param, None, 0.0)
+        wait = 0
+        if block:
+            wait = None
+            if self._schedule and len(self.runner.running) < self.concurrency:
+                wait = max(self._schedule[0][0] - time.time(), 0)
+        done = self.runner.poll(wait)
+        for (index, result, cost) in done:
+            self._finish(self._running.pop(index), result, cost)
+        return len(done)
+
+    def run(self, params):
+        self.schedule(params)
+        print 'TIME'.ljust(20) + 'NODE;COMMAND;BEFORE -> AFTER (LATENCY)'
+        try:
+            while self._schedule or self._running:
+                self.run_once(block=True)
+        finally:
+            self.runner.close()
+            self._running.clear()
+            self.loader._summary(self.recorder)
+
 #=============================test section===================
 def test_cmd():
     config = ConfigParser.ConfigParser()
@@ -243,7 +551,23 @@ def test_json_multi_cmds():
     cl = JsonConfigLoader()
     cl.load_config('config_json')
     params = ['%s;%s' %(i, j) for i in cl.nodes for j in cl.candidate_cmds]
-    cl.multi_run_and_check(params)
+    cl.multi_run_and_check(params, recorder=CheckRecorder())
+def test_json_loop_cmds():
+    cl = JsonConfigLoader()
+    cl.load_config('config_json')
+    params = ['%s;%s' %(i, j) for i in cl.nodes for j in cl.candidate_cmds]
+    recorder = CheckRecorder()
+    cl.loop_run_and_check(params, recorder=recorder)
+    recorder.save('status_checker_result.jsonl')
+def test_json_batch_cmds():
+    cl = JsonConfigLoader()
+    cl.load_config('config_json')
+    cl.batch_run_and_check(list(cl.nodes), recorder=CheckRecorder())
+def test_json_monitor():
+    cl = JsonConfigLoader()
+    cl.load_config('config_json')
+    params = ['%s;%s' %(i, j) for i in cl.nodes for j in cl.candidate_cmds]
+    StatusMonitor(cl, recorder=CheckRecorder()).run(params)
     
 
 #=============================main section===================
@@ -255,3 +579,6 @@ if __name__ == '__main__':
     #test_config_loader()
     #test_json_config_loader()
     test_json_multi_cmds()
+    #test_json_loop_cmds()
+    #test_json_batch_cmds()
+    #test_json_monitor()
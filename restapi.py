@@ -14,8 +14,18 @@ import getopt, sys, os, errno
 import getpass    
 import requests
 import json
+import urllib
+import urlparse
+import threading
+import time
+import hashlib
+import codecs
+from collections import OrderedDict
+from multiprocessing.dummy import Pool
 from requests.auth import HTTPBasicAuth
 from requests.auth import HTTPDigestAuth
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
 from HTMLParser import HTMLParser
 
 # Reference:
@@ -32,9 +42,9 @@ class parselinks(HTMLParser):
       The result contains all data that matches <a href="/job/></a>
   '''
   def __init__(self):
-      self.data=[]
+      self.data=set()
       self.href=0
-      self.linkname=''
+      self.linkname=[]
       HTMLParser.__init__(self)
   def handle_starttag(self,tag,attrs):
       if tag =='a':
@@ -43,17 +53,23 @@ class parselinks(HTMLParser):
                   self.href=1
   def handle_data(self,data):
       if self.href:
-          self.linkname+=data
+          self.linkname.append(data)
   def handle_endtag(self,tag):
       if tag=='a':
-          self.linkname=''.join(self.linkname.split())
-          self.linkname=self.linkname.strip()
-          if  self.linkname:
-              self.data.append(self.linkname)
-          self.linkname=''
+          linkname=''.join(''.join(self.linkname).split())
+          if  linkname:
+              self.data.add(linkname)
+          self.linkname=[]
           self.href=0
+  def feed_chunks(self,chunks,encoding='utf-8'):
+      ''' feed raw byte chunks as they are downloaded, e.g. r.iter_content()
+      '''
+      decoder=codecs.getincrementaldecoder(encoding)('replace')
+      for chunk in chunks:
+          self.feed(decoder.decode(chunk))
+      self.feed(decoder.decode('',final=True))
   def get_result(self):
-      for value in self.data:
+      for value in sorted(self.data):
           print value
           
 # exer1 : use curl to access http://httpbin.org/get
@@ -85,9 +101,9 @@ def exer4():
     server = "https://api.github.com"
     url = server + "/users"
     user = "mamahaha"
-    passwd = getpass.getpass('Password:')
+    client = rest_client(server, user, cache=http_cache())
     print "checking ", url, "using user:", user
-    r = requests.get(url, auth=HTTPBasicAuth(user,passwd))
+    r = client.get(url)
     print r
     #print json.dumps(r.json(), indent = 2)
     
@@ -148,6 +164,197 @@ server = "https://api.github.com"
 url = server + "/gists"
 user = "Mamahaha"
 
+class http_cache(object):
+  ''' On-disk cache of GET responses carrying an ETag or Last-Modified.
+      Entries are keyed by url and user, revalidated with If-None-Match or
+      If-Modified-Since, and evicted least recently used beyond max_bytes.
+  '''
+  def __init__(self, path=os.path.expanduser('~/.restapi_cache'), max_bytes=50*1024*1024):
+      self.path = path
+      self.max_bytes = max_bytes
+      self.lock = threading.Lock()
+      if not os.path.isdir(path):
+          os.makedirs(path, 0700)
+      entries = []
+      for name in os.listdir(path):
+          if name.endswith('.tmp'):
+              continue
+          st = os.stat(os.path.join(path, name))
+          entries.append((st.st_mtime, name, st.st_size))
+      self.entries = OrderedDict((name, size) for mtime, name, size in sorted(entries))
+      self.size = sum(self.entries.values())
+  def key(self, identity, url):
+      return hashlib.sha1('%s %s' %(identity, url)).hexdigest()
+  def get(self, key):
+      ''' (meta, body) or None
+      '''
+      with self.lock:
+          if key not in self.entries:
+              return None
+          self.entries[key] = self.entries.pop(key)
+      file = os.path.join(self.path, key)
+      try:
+          with open(file, 'rb') as fh:
+              meta = json.loads(fh.readline())
+              body = fh.read()
+          os.utime(file, None)
+      except (IOError, OSError, ValueError):
+          with self.lock:
+              self.size -= self.entries.pop(key, 0)
+          return None
+      return meta, body
+  def put(self, key, meta, body):
+      file = os.path.join(self.path, key)
+      tmp = '%s.%d.tmp' %(file, threading.current_thread().ident)
+      fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600)
+      with os.fdopen(fd, 'wb') as fh:
+          fh.write(json.dumps(meta) + '\n')
+          fh.write(body)
+      os.rename(tmp, file)
+      size = os.path.getsize(file)
+      with self.lock:
+          self.size -= self.entries.pop(key, 0)
+          self.entries[key] = size
+          self.size += size
+          while self.size > self.max_bytes and len(self.entries) > 1:
+              old, old_size = self.entries.popitem(last=False)
+              self.size -= old_size
+              try:
+                  os.remove(os.path.join(self.path, old))
+              except OSError:
+                  pass
+
+class rest_client(object):
+  ''' Shared HTTP client on top of one requests.Session.
+      Connections are kept alive and pooled, failed requests are retried
+      with backoff, and the password is asked for only once.
+      With a http_cache, GETs are revalidated and 304s served from disk.
+  '''
+  def __init__(self, server, user, passwd=None, retries=3, backoff=0.5, pool_size=10, timeout=30, verify=True, cache=None):
+      self.server = server
+      self.user = user
+      self.passwd = passwd
+      self.timeout = timeout
+      self.cache = cache
+      self.session = requests.Session()
+      self.session.verify = verify
+      retry = Retry(total=retries, backoff_factor=backoff, status_forcelist=(500, 502, 503, 504), raise_on_status=False)
+      adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+      self.session.mount('http://', adapter)
+      self.session.mount('https://', adapter)
+  def auth(self):
+      if self.passwd is None:
+          self.passwd = getpass.getpass('$Password:')
+      return HTTPBasicAuth(self.user, self.passwd)
+  def url(self, path):
+      if path.startswith('http://') or path.startswith('https://'):
+          return path
+      return self.server + path
+  def request(self, method, path, auth=True, **kwargs):
+      kwargs.setdefault('timeout', self.timeout)
+      if auth:
+          kwargs['auth'] = self.auth()
+      if self.cache is None or method != 'GET':
+          return self.session.request(method, self.url(path), **kwargs)
+      return self.cached_get(self.url(path), self.user if auth else '', **kwargs)
+  def cached_get(self, url, identity, **kwargs):
+      key_url = url
+      if kwargs.get('params'):
+          key_url += '?' + urllib.urlencode(sorted(kwargs['params'].items()))
+      key = self.cache.key(identity, key_url)
+      entry = self.cache.get(key)
+      if entry:
+          meta, body = entry
+          headers = dict(kwargs.get('headers') or {})
+          if meta.get('etag'):
+              headers['If-None-Match'] = meta['etag']
+          if meta.get('last_modified'):
+              headers['If-Modified-Since'] = meta['last_modified']
+          kwargs['headers'] = headers
+      r = self.session.get(url, **kwargs)
+      if r.status_code == 304 and entry:
+          r.status_code = meta['status']
+          r.reason = 'OK'
+          r.headers.update(meta['headers'])
+          r._content = body
+          r.from_cache = True
+      elif r.status_code == 200 and ('ETag' in r.headers or 'Last-Modified' in r.headers):
+          meta = {
+            'url'           : key_url,
+            'status'        : r.status_code,
+            'etag'          : r.headers.get('ETag'),
+            'last_modified' : r.headers.get('Last-Modified'),
+            'headers'       : dict((k, r.headers[k]) for k in ('Content-Type', 'Link') if k in r.headers),
+          }
+          self.cache.put(key, meta, r.content)
+      return r
+  def get(self, path, auth=True, **kwargs):
+      return self.request('GET', path, auth, **kwargs)
+  def post(self, path, auth=True, **kwargs):
+      return self.request('POST', path, auth, **kwargs)
+  def put(self, path, auth=True, **kwargs):
+      return self.request('PUT', path, auth, **kwargs)
+  def patch(self, path, auth=True, **kwargs):
+      return self.request('PATCH', path, auth, **kwargs)
+  def delete(self, path, auth=True, **kwargs):
+      return self.request('DELETE', path, auth, **kwargs)
+  def close(self):
+      self.session.close()
+
+gist_client = None
+
+def get_gist_client():
+  ''' the rest_client shared by all gist operations
+  '''
+  global gist_client
+  if gist_client is None:
+    gist_client = rest_client(server, user, cache=http_cache())
+  return gist_client
+
+def page_url(link, page):
+  ''' the Link header url with its page parameter replaced
+  '''
+  parts = urlparse.urlparse(link)
+  query = [(k, v) for k, v in urlparse.parse_qsl(parts.query) if k != 'page']
+  query.append(('page', str(page)))
+  return urlparse.urlunparse(parts._replace(query=urllib.urlencode(query)))
+
+def gist_pages(path, auth=True, per_page=100, concurrency=4, max_pages=None):
+  ''' Generator over all gists of a listing, following the Link headers.
+      When the first page announces the last one, the remaining pages are
+      fetched by up to `concurrency` threads; otherwise 'next' is followed.
+      Gists are yielded in listing order as soon as their page arrives.
+  '''
+  client = get_gist_client()
+  if auth:
+    client.auth()
+  def fetch(page_link):
+    r = client.get(page_link, auth=auth)
+    r.raise_for_status()
+    return r
+  r = fetch(client.url(path) + '?' + urllib.urlencode({'per_page' : per_page}))
+  for gist in r.json():
+    yield gist
+  if 'last' in r.links:
+    last = int(dict(urlparse.parse_qsl(urlparse.urlparse(r.links['last']['url']).query)).get('page', 1))
+    if max_pages:
+      last = min(last, max_pages)
+    links = [page_url(r.links['last']['url'], page) for page in range(2, last + 1)]
+    pool = Pool(concurrency)
+    try:
+      for r in pool.imap(fetch, links):
+        for gist in r.json():
+          yield gist
+    finally:
+      pool.terminate()
+  else:
+    pages = 1
+    while 'next' in r.links and (not max_pages or pages < max_pages):
+      r = fetch(r.links['next']['url'])
+      pages += 1
+      for gist in r.json():
+        yield gist
+
 # Implementation of gist api
 def exer71():
   ''' gist api implementation
@@ -163,6 +370,7 @@ def exer71():
     'checkstar'      : lambda : gist_check_star(),
     'fork'           : lambda : gist_fork(),
     'delete'         : lambda : gist_delete(),      
+    'bulk'           : lambda : gist_bulk(),
   }
   print '========gist api list==========='
   for item in gist_cmds.keys():
@@ -176,41 +384,34 @@ def exer71():
 def gist_auth():
   None
 def gist_list():
-  global server
   global user
-  passwd = getpass.getpass('$Password:')
 
   resp = {
-    'user'     : lambda : requests.get(server + '/users/' + user + '/gists', auth=HTTPBasicAuth(user,passwd)),
-    'all'      : lambda : requests.get(server + '/gists'),
-    'public'   : lambda : requests.get(server + '/gists/public'),
-    'starred'  : lambda : requests.get(server + '/gists/starred', auth=HTTPBasicAuth(user,passwd)),
+    'user'     : lambda : gist_pages('/users/' + user + '/gists'),
+    'all'      : lambda : gist_pages('/gists', auth=False),
+    'public'   : lambda : gist_pages('/gists/public', auth=False),
+    'starred'  : lambda : gist_pages('/gists/starred'),
   }
   print '========list type==========='
   for item in resp.keys():
     print item
   param = raw_input('\n$Choose a list type from above: ')
   if param in resp.keys():
-    r = resp[param]()
-    print r
-    print json.dumps(r.json(), indent = 2)
+    for gist in resp[param]():
+      print json.dumps(gist, indent = 2)
   else:
     print 'Error: No such list type'
   
 def gist_get():
-  global server
-  global user
-  passwd = getpass.getpass('$Password:')
+  client = get_gist_client()
   id = raw_input('\n$Input the commit id that you want to get: ')
-  r = requests.get(server + '/gists/' + id, auth=HTTPBasicAuth(user,passwd))
+  r = client.get('/gists/' + id)
   print r
   print json.dumps(r.json(), indent = 2)
 
 def gist_create():
-  global server
   global user
-  passwd = getpass.getpass('$Password:')
-  url = server + "/gists"
+  client = get_gist_client()
   commit = {
     "description": "the description for this gist",
     "public": "true",
@@ -221,18 +422,15 @@ def gist_create():
       }
     }
   }
-  r = requests.post(url, data=json.dumps(commit), auth=HTTPBasicAuth(user,passwd))
+  r = client.post('/gists', data=json.dumps(commit))
   print r
   print json.dumps(r.json(), indent = 2)
 
 def gist_update():
-  global server
-  global user
-  passwd = getpass.getpass('$Password:')
+  client = get_gist_client()
   #id = raw_input('\n$Input the commit id that you want to get: ')
   id = 'b584f07661af97270500'
-  url = server + "/gists/" + id
-  print url
+  print client.url('/gists/' + id)
   commit = {
     "description": "the description for this gist",
     "files": {
@@ -244,60 +442,152 @@ def gist_update():
       }
     }
   }
-  r = requests.patch(url, data=json.dumps(commit), auth=HTTPBasicAuth(user,passwd))
+  r = client.patch('/gists/' + id, data=json.dumps(commit))
   print r
   print json.dumps(r.json(), indent = 2)
   
 def gist_star():
-  global server
-  global user
-  passwd = getpass.getpass('$Password:')
+  client = get_gist_client()
   #id = raw_input('\n$Input the commit id that you want to get: ')
   id = '9360b120fc97767b2959'
-  url = server + "/gists/" + id + '/star'
-  r = requests.put(url, auth=HTTPBasicAuth(user,passwd))
+  r = client.put('/gists/' + id + '/star')
   print r
   
 def gist_unstar():
-  global server
-  global user
-  passwd = getpass.getpass('$Password:')
+  client = get_gist_client()
   #id = raw_input('\n$Input the commit id that you want to get: ')
   id = '9360b120fc97767b2959'
-  url = server + "/gists/" + id + '/star'
-  r = requests.delete(url, auth=HTTPBasicAuth(user,passwd))
+  r = client.delete('/gists/' + id + '/star')
   print r
   
 def gist_check_star():
-  global server
-  global user
-  passwd = getpass.getpass('$Password:')
+  client = get_gist_client()
   #id = raw_input('\n$Input the commit id that you want to get: ')
   id = '9360b120fc97767b2959'
-  url = server + "/gists/" + id + '/star'
-  r = requests.get(url, auth=HTTPBasicAuth(user,passwd))
+  r = client.get('/gists/' + id + '/star')
   print r
 
 def gist_fork():
-  global server
-  global user
-  passwd = getpass.getpass('$Password:')
+  client = get_gist_client()
   #id = raw_input('\n$Input the commit id that you want to get: ')
   id = '9360b120fc97767b2959'
-  url = server + "/gists/" + id + '/forks'
-  r = requests.post(url, auth=HTTPBasicAuth(user,passwd))
+  r = client.post('/gists/' + id + '/forks')
   print r
   print json.dumps(r.json(), indent = 2)
   
 def gist_delete():
-  global server
-  global user
-  passwd = getpass.getpass('$Password:')
+  client = get_gist_client()
   #id = raw_input('\n$Input the commit id that you want to get: ')
   id = '9360b120fc97767b2959'
-  url = server + "/gists/" + id
-  r = requests.delete(url, auth=HTTPBasicAuth(user,passwd))
+  r = client.delete('/gists/' + id)
   print r
+
+# bulk operation -> (method, path after /gists/<id>, accepted status codes)
+gist_bulk_ops = {
+  'get'       : ('GET', '', None),
+  'star'      : ('PUT', '/star', None),
+  'unstar'    : ('DELETE', '/star', None),
+  'checkstar' : ('GET', '/star', (204, 404)),
+  'fork'      : ('POST', '/forks', None),
+  'delete'    : ('DELETE', '', None),
+}
+
+class rate_limiter(object):
+  ''' Shared by the bulk workers. Once github reports the rate limit is used up
+      (Retry-After, or X-RateLimit-Remaining: 0) every worker waits for the reset.
+  '''
+  def __init__(self):
+      self.lock = threading.Lock()
+      self.resume_at = 0
+  def wait(self):
+      while True:
+          with self.lock:
+              delay = self.resume_at - time.time()
+          if delay <= 0:
+              return
+          time.sleep(delay)
+  def update(self, r):
+      ''' True when r was rejected by the rate limit and should be sent again
+      '''
+      resume_at = 0
+      try:
+          if 'Retry-After' in r.headers:
+              resume_at = time.time() + float(r.headers['Retry-After'])
+          elif r.headers.get('X-RateLimit-Remaining') == '0' and 'X-RateLimit-Reset' in r.headers:
+              resume_at = float(r.headers['X-RateLimit-Reset'])
+      except ValueError:
+          resume_at = time.time() + 60
+      if resume_at:
+          with self.lock:
+              self.resume_at = max(self.resume_at, resume_at)
+      return r.status_code in (403, 429) and resume_at > 0
+
+def gist_bulk_one(client, limiter, op, id, retries=3):
+  ''' returns (id, status_code, cost, error)
+  '''
+  method, postfix, accepted = gist_bulk_ops[op]
+  start = time.time()
+  try:
+    for attempt in range(retries + 1):
+      limiter.wait()
+      r = client.request(method, '/gists/' + id + postfix)
+      if not limiter.update(r):
+        break
+    if accepted is None:
+      ok = r.status_code < 400
+    else:
+      ok = r.status_code in accepted
+    return id, r.status_code, time.time() - start, None if ok else r.reason
+  except Exception, ex:
+    return id, None, time.time() - start, str(ex)
+
+def gist_bulk_run(ids, op, concurrency=8):
+  ''' Run one gist operation over many ids with a bounded pool of threads
+      sharing the pooled client, then print a latency/error summary.
+  '''
+  client = get_gist_client()
+  client.auth()
+  limiter = rate_limiter()
+  pool = Pool(concurrency)
+  start = time.time()
+  try:
+    results = pool.map(lambda id : gist_bulk_one(client, limiter, op, id), ids)
+  finally:
+    pool.terminate()
+  gist_bulk_summary(op, results, time.time() - start)
+  return results
+
+def gist_bulk_summary(op, results, elapsed):
+  costs = sorted(cost for id, status, cost, error in results)
+  statuses = {}
+  errors = []
+  for id, status, cost, error in results:
+    statuses[status] = statuses.get(status, 0) + 1
+    if error:
+      errors.append((id, status, error))
+  print '========bulk %s summary===========' % op
+  print 'requests: %d in %.2fs, errors: %d' % (len(results), elapsed, len(errors))
+  if costs:
+    pick = lambda q : costs[min(len(costs) - 1, int(q * len(costs)))]
+    print 'latency(s): min %.3f  avg %.3f  p50 %.3f  p95 %.3f  max %.3f' % (
+      costs[0], sum(costs) / len(costs), pick(0.5), pick(0.95), costs[-1])
+  for status in sorted(statuses.keys()):
+    print '  status %s: %d' % (status, statuses[status])
+  for id, status, error in errors[:20]:
+    print '  failed %s: %s %s' % (id, status, error)
+
+def gist_bulk():
+  path = raw_input('\n$Input the file of gist ids, one per line: ')
+  print '========bulk operation==========='
+  for item in gist_bulk_ops.keys():
+    print item
+  op = raw_input('\n$Choose a bulk operation from above: ')
+  if op not in gist_bulk_ops:
+    print 'Error: Unsupported bulk operation'
+    return
+  with open(path) as fh:
+    ids = [line.strip() for line in fh if line.strip() and not line.startswith('#')]
+  gist_bulk_run(ids, op)
 ############end of exer71#####################
  
 def oauth_usage():
@@ -370,19 +660,34 @@ def oauth_usage():
   #print r8
   #print json.dumps(r8.json(), indent = 2)
 
+def jenkins_jobs_api(client, url):
+  ''' job names from the jenkins json api, None when it is not available
+  '''
+  try:
+    r = client.get(url.rstrip('/') + '/api/json', params={'tree' : 'jobs[name]'})
+    if r.status_code != 200:
+      return None
+    return set(job['name'] for job in r.json().get('jobs', []))
+  except (ValueError, KeyError, requests.RequestException):
+    return None
+
 def get_jenkins_jobs():
   url1 = '' #your jenkins url
   user = '' #your jenkins user
-  passwd = getpass.getpass('Password:')
-  user_auth = HTTPBasicAuth(user, passwd)
-  #this will return a html-format respone, and we need a html parser to get all jobs
-  r = requests.get(url1, auth=user_auth, verify=False) 
-  print r
-  r2 = parselinks()
-  data = r.content.decode('utf-8')
-  r2.feed(data)
-  r2.get_result()
-  r2.close()
+  client = rest_client(url1, user, verify=False)
+  jobs = jenkins_jobs_api(client, url1)
+  if jobs is not None:
+    for job in sorted(jobs):
+      print job
+  else:
+    #this will return a html-format respone, and we need a html parser to get all jobs
+    r = client.get(url1, stream=True)
+    print r
+    r2 = parselinks()
+    r2.feed_chunks(r.iter_content(64 * 1024))
+    r2.get_result()
+    r2.close()
+  client.close()
   
   
 def enable_debug():
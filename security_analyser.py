@@ -2,6 +2,10 @@
 
 import urllib
 import urllib2
+import httplib
+import urlparse
+import socket
+import threading
 import time 
 import re
 
@@ -18,15 +22,87 @@ def save2File(filePath, content):
   except Exception, ex:
     return False
   
-def loader(url_string): 
+class quote_client(object):
+  ''' One keep-alive HTTP/1.1 connection shared by all loaders.
+      urllib2 opens a new connection for every request, so this talks httplib
+      directly: to the proxy with absolute urls when one is set, else to the host.
+      Broken connections are reopened and the request retried with backoff.
+  '''
+  def __init__(self, proxy=None, timeout=10, retries=3, backoff=0.5):
+    self.proxy = proxy
+    self.timeout = timeout
+    self.retries = retries
+    self.backoff = backoff
+    self.lock = threading.Lock()
+    self.conn = None
+    self.target = None
+
+  def close(self):
+    if self.conn is not None:
+      self.conn.close()
+    self.conn = None
+
+  def connect(self, host):
+    target = self.proxy or host
+    if self.conn is None or self.target != target:
+      self.close()
+      self.conn = httplib.HTTPConnection(target, timeout=self.timeout)
+      self.target = target
+    return self.conn
+
+  def fetch(self, host, path):
+    ''' One request on the kept connection, returns (response, body).
+        An idle connection the peer has closed in the meantime fails before
+        any response; it is reopened and the request sent again at once.
+    '''
+    with self.lock:
+      reused = self.conn is not None and self.target == (self.proxy or host)
+      conn = self.connect(host)
+      try:
+        conn.request('GET', path, headers={'Host' : host})
+        resp = conn.getresponse()
+      except socket.timeout:
+        raise
+      except (httplib.BadStatusLine, socket.error):
+        self.close()
+        if not reused:
+          raise
+        conn = self.connect(host)
+        conn.request('GET', path, headers={'Host' : host})
+        resp = conn.getresponse()
+      body = resp.read()
+      if resp.will_close:
+        self.close()
+      return (resp, body)
+
+  def get(self, url):
+    parts = urlparse.urlsplit(url)
+    if self.proxy:
+      path = url
+    else:
+      path = (parts.path or '/') + ('?' + parts.query if parts.query else '')
+    for attempt in range(self.retries + 1):
+      try:
+        (resp, body) = self.fetch(parts.netloc, path)
+        if resp.status >= 500 and attempt < self.retries:
+          raise httplib.HTTPException('HTTP %d %s' %(resp.status, resp.reason))
+        if resp.status >= 400:
+          raise urllib2.HTTPError(url, resp.status, resp.reason, resp.msg, None)
+        return body
+      except (httplib.HTTPException, socket.error), ex:
+        with self.lock:
+          self.close()
+        if attempt == self.retries:
+          raise
+        print '[Error] %s, retrying %s' %(ex, url)
+        time.sleep(self.backoff * 2 ** attempt)
 
 ### for cbc env   ####################
-  proxy_support = urllib2.ProxyHandler({'http':'http://www-proxy.ao.ericsson.se:8080'})
-  opener = urllib2.build_opener(proxy_support)
-  urllib2.install_opener(opener)
+quote_http = quote_client('www-proxy.ao.ericsson.se:8080')
 ######################################
 
-  resp = urllib2.urlopen(url_string).read()
+def loader(url_string): 
+  resp = quote_http.get(url_string)
   print resp
   
   flag = save2File('data.txt', resp)
@@ -36,14 +112,7 @@ def loader(url_string):
     flag = save2File('data.txt', resp)
 
 def loader2(): 
-
-### for cbc env   ####################
-  proxy_support = urllib2.ProxyHandler({'http':'http://www-proxy.ao.ericsson.se:8080'})
-  opener = urllib2.build_opener(proxy_support)
-  urllib2.install_opener(opener)
-######################################
-
-  resp = urllib2.urlopen(urlString2).read()
+  resp = quote_http.get(urlString2)
   print resp
 
   flag = save2File('data_benchmark.txt', resp)
@@ -53,12 +122,7 @@ def loader2():
     flag = save2File('data_benchmark.txt', resp)
 
 def load_data(url_string):
-#Only for company start#########
-  proxy_support = urllib2.ProxyHandler({'http':'http://www-proxy.ao.ericsson.se:8080'})
-  opener = urllib2.build_opener(proxy_support)
-  urllib2.install_opener(opener)
-#Only for company end#########
-  resp = urllib2.urlopen(url_string).read()
+  resp = quote_http.get(url_string)
   #print resp.strip()
   return resp.strip()
 
@@ -83,15 +147,47 @@ def parse_input(fp):
     input_list.append(n_l)
 
 def parse_all():
+  # one batched request for every symbol of this poll
+  symbols = []
   for i in input_list:
-    parse_data(i)
+    for symbol in symbols_of(i):
+      if symbol not in symbols:
+        symbols.append(symbol)
+  quotes = load_quotes(symbols)
+  for i in input_list:
+    missing = [symbol for symbol in symbols_of(i) if symbol not in quotes]
+    if missing:
+      print '[Error] no quote for', missing
+      continue
+    parse_data(i, quotes)
 
+def symbols_of(line):
+  return ('sz%s' %line[0], 'sz%s' %line[1], 'f_%s' %line[2], line[3])
+
+hq_pattern = re.compile(r'var hq_str_(\w+)="')
+def split_quotes(resp):
+  ''' {symbol : 'var hq_str_<symbol>="...";'} from a batched response
+  '''
+  quotes = {}
+  for l in resp.splitlines():
+    l = l.strip()
+    m = hq_pattern.match(l)
+    if m:
+      quotes[m.group(1)] = l
+  return quotes
+
+def load_quotes(symbols, batch_size=200):
+  quotes = {}
+  for i in range(0, len(symbols), batch_size):
+    resp = load_data('http://hq.sinajs.cn/list=%s' %','.join(symbols[i:i+batch_size]))
+    quotes.update(split_quotes(resp))
+  return quotes
   
-def parse_data(line):
-  a = parse_AB(line[0])
-  b = parse_AB(line[1])
-  parent = parse_parent(line[2])
-  benchmark = parse_benchmark(line[3])
+def parse_data(line, quotes=None):
+  a = parse_AB(line[0], quotes)
+  b = parse_AB(line[1], quotes)
+  parent = parse_parent(line[2], quotes)
+  benchmark = parse_benchmark(line[3], quotes)
   a_weight = line[4]
   b_weight = line[5]
   #print 'a:',a
@@ -137,20 +233,22 @@ def process_impact_degree(a_price, a_amount, b_price, b_amount, a_weight, b_weig
   #print (buy_percentage_a, buy_percentage_b)
   return (buy_percentage_a, buy_percentage_b)
   
-def parse_AB(s):
-  url_string = 'http://hq.sinajs.cn/list=sz%s' %s
-  resp = load_data(url_string)
+def load_quote(symbol, quotes=None):
+  if quotes is not None:
+    return quotes[symbol]
+  return load_data('http://hq.sinajs.cn/list=%s' %symbol)
+
+def parse_AB(s, quotes=None):
+  resp = load_quote('sz%s' %s, quotes)
   return parse_resp_AB(resp)
   
   
-def parse_parent(s):
-  url_string = 'http://hq.sinajs.cn/list=f_%s' %s
-  resp = load_data(url_string)
+def parse_parent(s, quotes=None):
+  resp = load_quote('f_%s' %s, quotes)
   return parse_resp_parent(resp)
 
-def parse_benchmark(s):
-  url_string = 'http://hq.sinajs.cn/list=%s' %s
-  resp = load_data(url_string)
+def parse_benchmark(s, quotes=None):
+  resp = load_quote(s, quotes)
   return parse_resp_benchmark(resp)
   
   